@@ -0,0 +1,99 @@
+"""
+Benchmarks vectorized `fill_placeholders` against the previous row-wise implementation
+and checks that both produce identical output.
+Run from root.
+"""
+from random import choice, seed
+import re
+from time import perf_counter
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from src_old.constants import PNAME_PLACEHOLDER_RE, PNAME_SUB
+from src_old.data.atomic import fill_placeholders
+
+Dataframe = pd.DataFrame
+
+
+def legacy_fill_placeholders(atomic: Dataframe,
+                             columns: List[str] = ['head', 'tail']) -> Dataframe:
+    """Previous implementation using `apply` per cell and `iterrows`"""
+    df = atomic
+    names = list(PNAME_SUB)
+    df['origin'] = df['head']
+
+    def fill_obj(row):
+        if row['relation'] == 'isFilledBy':
+            return row['head'].replace('___', row['tail'])
+        else:
+            return row['head']
+
+    def replace(x: str, placeholder: str, replace_with: str) -> str:
+        if isinstance(x, str) and re.search(placeholder, x) is not None:
+            return re.sub(placeholder, replace_with, x)
+        return x
+
+    for i in PNAME_PLACEHOLDER_RE:
+        rex = re.compile(i, flags=re.IGNORECASE)
+        name = choice(names)
+        for col in columns:
+            df[col] = df[col].apply(
+                lambda x: replace(x, placeholder=rex, replace_with=name))
+        names.remove(name)
+
+    for i, row in df.iterrows():
+        df.loc[i, 'head'] = fill_obj(row)
+
+    df['head'] = df['head'].apply(lambda x: x.replace('___', '_'))
+    return df
+
+
+def synthetic_atomic(n_rows: int, random_state: int = 42) -> Dataframe:
+    """Creates atomic-like triples with placeholders, `___` and missing tails"""
+    rng = np.random.default_rng(random_state)
+    heads = np.array([
+        'PersonX goes to the store', 'PersonX gives PersonY a ___',
+        'personx asks Person Y about PersonZ', 'PersonX eats ___ for dinner',
+        'bread', 'PersonX calls PersonY'
+    ])
+    tails = np.array([
+        'none', 'to be happy', 'PersonY gets tired', 'present', 'pizza',
+        'person x thanks PersonY', np.nan
+    ], dtype=object)
+    relations = np.array(['xIntent', 'oReact', 'isFilledBy', 'xNeed', 'AtLocation'])
+
+    df = Dataframe({
+        'head': heads[rng.integers(len(heads), size=n_rows)],
+        'relation': relations[rng.integers(len(relations), size=n_rows)],
+        'tail': tails[rng.integers(len(tails), size=n_rows)],
+    })
+    # isFilledBy always has a tail
+    filled = df['relation'] == 'isFilledBy'
+    df.loc[filled & df['tail'].isna(), 'tail'] = 'pizza'
+    return df
+
+
+def benchmark(n_rows: int = 20000, random_state: int = 42):
+    data = synthetic_atomic(n_rows, random_state)
+
+    seed(random_state)
+    start = perf_counter()
+    expected = legacy_fill_placeholders(data.copy())
+    legacy_time = perf_counter() - start
+
+    seed(random_state)
+    start = perf_counter()
+    result = fill_placeholders(data.copy())
+    vectorized_time = perf_counter() - start
+
+    pd.testing.assert_frame_equal(result, expected)
+    print(f'Rows: {n_rows}')
+    print(f'Legacy:     {legacy_time:.2f}s')
+    print(f'Vectorized: {vectorized_time:.2f}s')
+    print(f'Speedup:    {legacy_time / vectorized_time:.1f}x, outputs are identical')
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,101 @@
+"""
+Benchmarks the groupby based `merge_verb_data` against the previous implementation
+filtering the verb frame once per action and checks that both collect the same knowledge.
+Run from root.
+"""
+import json
+import os
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import List
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from src_old.data.dataset import ATOMIC_LIST_COLUMNS, merge_verb_data, parse_list
+
+Dataframe = pd.DataFrame
+
+
+def legacy_merge_verb_data(n_actions: int, verb_frame: str) -> Dataframe:
+    """Previous implementation using a boolean filter per action and `eval`"""
+    verb_frame = pd.read_csv(verb_frame, sep='\t', encoding='utf8')
+    candidate_df = []
+
+    for i in range(n_actions):
+        tmp = {k: [] for k in ATOMIC_LIST_COLUMNS}
+        for _, a in verb_frame[verb_frame['id'] == i].iterrows():
+            for k in tmp.keys():
+                tmp[k].extend(eval(a[k]))
+
+        candidate_df.append(tmp)
+
+    return pd.DataFrame(candidate_df)
+
+
+def synthetic_data(n_actions: int,
+                   n_atomic: int,
+                   density: float = 0.002,
+                   random_state: int = 42) -> tuple:
+    """Creates atomic rows with stringified list columns and random action matches"""
+    rng = np.random.default_rng(random_state)
+    words = np.array(['to eat', 'happy', 'none', 'to sleep', 'tired', 'go', 'give'])
+    atomic = Dataframe({
+        k: [
+            json.dumps(list(words[rng.integers(len(words), size=n)]))
+            for n in rng.integers(0, 4, size=n_atomic)
+        ]
+        for k in ATOMIC_LIST_COLUMNS
+    })
+    matches = sparse.random(n_actions,
+                            n_atomic,
+                            density=density,
+                            format='csr',
+                            random_state=random_state)
+    matches.data[:] = 1
+    return atomic, matches
+
+
+def legacy_verb_frame(atomic: Dataframe, matches: sparse.csr_matrix,
+                      save_to: str):
+    """Verb frame as written by the previous pipeline, one row per match
+    holding the stringified list of its stringified atomic cells"""
+    coo = matches.tocoo()
+    frame = atomic.iloc[coo.col].applymap(lambda x: str([x]))
+    frame.insert(0, 'id', coo.row)
+    frame.to_csv(save_to, sep='\t', encoding='utf8', index=False)
+
+
+def flatten(cells: List[str]) -> list:
+    """Legacy cells hold stringified atomic lists, the new ones their elements"""
+    return [v for c in cells for v in parse_list(c)]
+
+
+def benchmark(sizes: List[int] = [1000, 2000, 4000], random_state: int = 42):
+    for n_actions in sizes:
+        atomic, matches = synthetic_data(n_actions, 5 * n_actions,
+                                         random_state=random_state)
+
+        with TemporaryDirectory() as tmp:
+            verb_frame = os.path.join(tmp, 'complete_verb_frame.tsv')
+            legacy_verb_frame(atomic, matches, verb_frame)
+            start = perf_counter()
+            expected = legacy_merge_verb_data(n_actions, verb_frame)
+            legacy_time = perf_counter() - start
+
+            start = perf_counter()
+            result = merge_verb_data(matches,
+                                     atomic,
+                                     save_to=os.path.join(tmp, 'candidates.parquet'))
+            grouped_time = perf_counter() - start
+
+        pd.testing.assert_frame_equal(result, expected.applymap(flatten))
+        print(f'Actions: {n_actions}, matches: {matches.nnz}')
+        print(f'Legacy:  {legacy_time:.2f}s')
+        print(f'Grouped: {grouped_time:.2f}s')
+        print(f'Speedup: {legacy_time / grouped_time:.1f}x, outputs are identical')
+
+
+if __name__ == "__main__":
+    benchmark()
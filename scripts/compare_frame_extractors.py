@@ -0,0 +1,70 @@
+"""
+Compares spacy dependency frames against allennlp srl for retrieval.
+Reports speedup and how much the retrieved candidate heads agree.
+Run from root.
+"""
+from time import perf_counter
+from typing import Callable, List, Set
+
+import datasets
+# hy needed for modules written in hy-lang [knowledge_extraction]
+import hy
+import numpy as np
+
+from src_old.knowledge_extraction import extract_phrases, kb
+from src_old.nlp import dependency_frames_batch, lemmatize, srl_batch
+
+
+def candidates(frames: list) -> Set[int]:
+    """Collects all lemma index heads matching the verbs of a sentence"""
+    verbs, _ = extract_phrases(frames)
+    return {
+        int(i)
+        for v in verbs for i in kb.lemma_index.ids(lemmatize(v), on='verbs')
+    }
+
+
+def timed(f: Callable, sentences: List[str], batch_size: int) -> tuple:
+    """Runs frame extractor in batches and measures wall time"""
+    start = perf_counter()
+    frames = []
+    for i in range(0, len(sentences), batch_size):
+        frames.extend(f(sentences[i:i + batch_size]))
+    return frames, perf_counter() - start
+
+
+def compare(n_samples: int = 500, batch_size: int = 32, seed: int = 42):
+    data = datasets.load_dataset('benjaminbeilharz/ed-for-lm', split='test')
+    data = data.shuffle(seed=seed).select(range(n_samples))
+    sentences = [s.replace('_comma_', ',') for s in data['current']]
+
+    # warm up both models, so loading is not measured
+    srl_batch(sentences[:1])
+    dependency_frames_batch(sentences[:1])
+
+    srl_frames, srl_time = timed(srl_batch, sentences, batch_size)
+    dep_frames, dep_time = timed(dependency_frames_batch, sentences,
+                                 batch_size)
+
+    jaccard = []
+    verb_agreement = []
+    for s, d in zip(srl_frames, dep_frames):
+        s_verbs = set(extract_phrases(s)[0])
+        d_verbs = set(extract_phrases(d)[0])
+        if s_verbs or d_verbs:
+            verb_agreement.append(
+                len(s_verbs & d_verbs) / len(s_verbs | d_verbs))
+        s_cands, d_cands = candidates(s), candidates(d)
+        if s_cands or d_cands:
+            jaccard.append(len(s_cands & d_cands) / len(s_cands | d_cands))
+
+    print(f'Sentences: {n_samples}')
+    print(f'SRL:        {srl_time:.2f}s ({1000 * srl_time / n_samples:.1f}ms per sentence)')
+    print(f'Dependency: {dep_time:.2f}s ({1000 * dep_time / n_samples:.1f}ms per sentence)')
+    print(f'Speedup:    {srl_time / dep_time:.1f}x')
+    print(f'Verb agreement (jaccard):      {np.mean(verb_agreement):.3f}')
+    print(f'Candidate agreement (jaccard): {np.mean(jaccard):.3f}')
+
+
+if __name__ == "__main__":
+    compare()
@@ -1,6 +1,18 @@
 import os
 
 DATA_ROOT = os.getcwd() + '/data'
+# files and directories retrieval reads from, used to version cached results
+ATOMIC_KNOWLEDGE_BASE = [
+    f'{DATA_ROOT}/atomic/{p}' for p in
+    ['lemma_index', 'relation_store', 'head_embeddings', 'ivf_index', 'version']
+]
+# spacy package or path to a local model directory
+SPACY_MODEL = os.environ.get('SPACY_MODEL', 'en_core_web_lg')
+# allennlp srl model url or path to a local model archive
+SRL_MODEL = os.environ.get(
+    'SRL_MODEL',
+    'https://storage.googleapis.com/allennlp-public-models/structured-prediction-srl-bert.2020.12.15.tar.gz'
+)
 PNAME_PLACEHOLDER_RE = ['Person\s?X', 'Person\s?Y', 'Person\s?Z']
 PNAME_SUB = ['Peter', 'Shannon', 'Clara', 'Jacob', 'Sandra', 'Nick']
 T5_TURN_TEMPLATES = {
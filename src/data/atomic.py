@@ -1,19 +1,23 @@
 """Atomic Processing Utils"""
 
 from src_old.constants import DATA_ROOT, PNAME_PLACEHOLDER_RE, PNAME_SUB
+from src_old.data.columnar import encode, load_cached
+from src_old.data.parse_store import ParseStore, StructureCounts, count_structures, read_parse_stores, relation_frame
+from src_old.data.relation_store import ENTITY_RELATIONS, PHYSICAL_RELATIONS, InvertedIndex, StringTable
+from src_old.data.shards import ShardManifest, content_hash
 
-from collections import defaultdict, Counter
+from collections import defaultdict
 from functools import partial
 from glob import iglob
+import os
 import pickle
-from random import choice
+from random import Random, choice
 import re
-from typing import Dict, List, NamedTuple, Tuple
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Tuple
 
 import pandas as pd
 from tqdm import tqdm
 from spacy.tokens.doc import Doc
-import spacy.symbols as S
 
 read_tsv = partial(pd.read_csv, sep='\t', encoding='utf8', header=None)
 Dataframe = pd.DataFrame
@@ -24,29 +28,164 @@ class Relation(NamedTuple):
     tail: str
 
 
+class LemmaIndex:
+    """Inverted index of the ATOMIC lookup table, head ids are positions in `texts`.
+    All parts are saved as numpy arrays, which can be memory mapped read-only."""
+    def __init__(self, texts: StringTable, origins: StringTable,
+                 verbs: InvertedIndex, objects: InvertedIndex):
+        self.texts = texts
+        self.origins = origins
+        self.verbs = verbs
+        self.objects = objects
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def ids(self, lemma: str, on: str = 'verbs') -> List[int]:
+        """Returns ids of all heads containing lemma
+
+        Args:
+            lemma - lemmatized query
+            on - inverted index to use: verbs, objects
+
+        Returns:
+            list of head ids
+        """
+        return getattr(self, on).get(lemma, [])
+
+    def search(self, lemma: str, on: str = 'verbs') -> Dict[str, str]:
+        """Returns all heads containing lemma
+
+        Args:
+            lemma - lemmatized query
+            on - inverted index to use: verbs, objects
+
+        Returns:
+            dict of parsed head text to original atomic head
+        """
+        return {self.texts[i]: self.origins[i] for i in self.ids(lemma, on)}
+
+    @classmethod
+    def from_lookup(cls,
+                    lookup: Dict[str, Dict[str, List[str]]],
+                    start: int = 0) -> 'LemmaIndex':
+        """Builds index from lookup entries created by `lookup_entries`
+
+        Args:
+            lookup - dict of parsed head text to origin, verbs and objects
+            start - id of the first head
+
+        Returns:
+            inverted lemma index
+        """
+        texts = []
+        origins = []
+        verbs = defaultdict(list)
+        objects = defaultdict(list)
+        for i, (text, entry) in enumerate(lookup.items(), start=start):
+            texts.append(text)
+            origins.append(entry['text'])
+            # a head is indexed once per lemma
+            for v in dict.fromkeys(entry['verbs']):
+                verbs[v].append(i)
+            for o in dict.fromkeys(entry['objects']):
+                objects[o].append(i)
+
+        return cls(StringTable.from_strings(texts),
+                   StringTable.from_strings(origins),
+                   InvertedIndex.from_postings(verbs),
+                   InvertedIndex.from_postings(objects))
+
+    def extend(self, lookup: Dict[str, Dict[str, List[str]]]) -> 'LemmaIndex':
+        """Appends heads, existing head ids stay valid
+
+        Args:
+            lookup - lookup entries of new heads, already indexed heads are skipped
+
+        Returns:
+            extended lemma index
+        """
+        lookup = {k: v for k, v in lookup.items() if self.texts.id(k) < 0}
+        new = LemmaIndex.from_lookup(lookup, start=len(self))
+        return LemmaIndex(self.texts.concat(new.texts),
+                          self.origins.concat(new.origins),
+                          self.verbs.merge(new.verbs),
+                          self.objects.merge(new.objects))
+
+    def save(self, path: str = f'{DATA_ROOT}/atomic/lemma_index'):
+        os.makedirs(path, exist_ok=True)
+        self.texts.save(path, 'texts')
+        self.origins.save(path, 'origins')
+        self.verbs.save(path, 'verbs')
+        self.objects.save(path, 'objects')
+
+    @classmethod
+    def load(cls,
+             path: str = f'{DATA_ROOT}/atomic/lemma_index',
+             mmap_mode: str = 'r') -> 'LemmaIndex':
+        return cls(StringTable.load(path, 'texts', mmap_mode),
+                   StringTable.load(path, 'origins', mmap_mode),
+                   InvertedIndex.load(path, 'verbs', mmap_mode),
+                   InvertedIndex.load(path, 'objects', mmap_mode))
+
+
+def read_atomic_files(files: List[str]) -> Dataframe:
+    """Reads atomic triples from tsv files
+
+    Args:
+        files - atomic tsv files
+
+    Returns:
+        atomic dataframe with categorical relations and dictionary encoded heads and tails
+    """
+    frames = []
+    for file in files:
+        print(file)
+        frames.append(
+            read_tsv(file,
+                     usecols=[0, 1, 2],
+                     names=['head', 'relation', 'tail'],
+                     low_memory=False))
+    df = pd.concat(frames, ignore_index=True)
+    df.index.name = 'index'
+    return encode(df, ['head', 'relation', 'tail'])
+
+
 def load_atomic_data(glob_path: str = f'{DATA_ROOT}/atomic/*.tsv',
-                     save: bool = False) -> Dataframe:
+                     save: bool = False,
+                     cache: str = f'{DATA_ROOT}/atomic/kb',
+                     columns: List[str] = None,
+                     categorical: bool = False) -> Dataframe:
     """Load atomic dataset from glob path
 
     Args:
         glob_path - path to atomic folder
         save - if true saves dataframe to disk
+        cache - directory of the columnar build, rebuilt when a source file
+            changes, if `None` the tsv files are read directly
+        columns - columns to load, defaults to all
+        categorical - if true heads and tails are kept as categoricals,
+            otherwise they are decoded to strings for in-place editing
 
     Returns:
         atomic dataframe
     """
+    files = [
+        f for f in iglob(glob_path, recursive=False)
+        if not f.endswith('processed.tsv')
+    ]
+    if cache is None:
+        df = read_atomic_files(sorted(files))
+        df = df if columns is None else df[columns]
+    else:
+        df = load_cached(files, cache, read_atomic_files, columns)
+
+    if not categorical:
+        df = df.astype({
+            c: object
+            for c in ['head', 'tail'] if c in df.columns
+        })
 
-    data_dict = {'head': [], 'relation': [], 'tail': []}
-
-    for file in iglob(glob_path, recursive=False):
-        if file.endswith('processed.tsv'): continue
-        print(file)
-        tmp = read_tsv(file, low_memory=False)
-        for i, k in enumerate(data_dict.keys()):
-            # retrieve columns and put them into data_dict
-            data_dict[k].extend(tmp.iloc[:, i].tolist())
-
-    df = Dataframe.from_dict(data_dict).reset_index().set_index('index')
     if save:
         df_path = f'{DATA_ROOT}/atomic/processed.tsv'
         serialized = f'{DATA_ROOT}/atomic/atomic.pickle'
@@ -58,57 +197,93 @@ def load_atomic_data(glob_path: str = f'{DATA_ROOT}/atomic/*.tsv',
     return df
 
 
+def partition_atomic(atomic: Dataframe) -> Dict[str, Dataframe]:
+    """Partitions atomic by relation once, so attribute extraction does not
+    scan the complete dataframe
+
+    Args:
+        atomic - atomic dataframe
+
+    Returns:
+        dict of relation to dataframe holding its triples
+    """
+    return {
+        r: frame
+        for r, frame in atomic.groupby('relation', observed=True, sort=False)
+    }
+
+
+def _select(atomic: Dataframe, partitions: Dict[str, Dataframe],
+            relations: List[str]) -> Dataframe:
+    """Concatenates partitions of relations in original row order"""
+    frames = [partitions[r] for r in relations if r in partitions]
+    if not frames:
+        return atomic.iloc[:0]
+    return pd.concat(frames).sort_index()
+
+
 def physical_entity_attributes(
-        atomic: Dataframe) -> Tuple[Dataframe, Dataframe]:
+        atomic: Dataframe,
+        partitions: Dict[str, Dataframe] = None) -> Tuple[Dataframe, Dataframe]:
     """Extracts physical and entity attributes from Atomic
     
     Args:
         atomic - atomic dataframe
+        partitions - relation partitions from `partition_atomic`, computed if not given
 
     Returns:
         dataframe only containing physical-entity attributes
     """
-    phy_attrs = ['ObjectUse', 'AtLocation', 'MadeUpOf', 'HasProperty']
-    ent_attrs = ['CapableOf', 'Desires', 'NotDesires']
+    if partitions is None:
+        partitions = partition_atomic(atomic)
 
-    phy_frame = atomic[~atomic['relation'].isin(phy_attrs)]
-    ent_frame = atomic[~atomic['relation'].isin(ent_attrs)]
+    phy_frame = _select(atomic, partitions, PHYSICAL_RELATIONS)
+    ent_frame = _select(atomic, partitions, ENTITY_RELATIONS)
 
     return (phy_frame, ent_frame)
 
 
-def social_attributes(atomic: Dataframe) -> Dataframe:
+def social_attributes(atomic: Dataframe,
+                      partitions: Dict[str, Dataframe] = None) -> Dataframe:
     """Extracts social attributes from Atomic
     
     Args:
         atomic - atomic dataframe
+        partitions - relation partitions from `partition_atomic`, computed if not given
 
     Returns:
         dataframe only containing social attributes
     """
+    if partitions is None:
+        partitions = partition_atomic(atomic)
     attrs = [
         'xNeed', 'xAttr', 'xEffect', 'xReact', 'xWant', 'xIntent', 'oEffect',
         'oReact', 'oWant'
     ]
 
-    df = atomic[~atomic['relation'].isin(attrs)]
+    df = _select(atomic, partitions, attrs)
 
     return df
 
 
-def event_attributes(atomic: Dataframe) -> Tuple[Dataframe, Dataframe]:
+def event_attributes(
+        atomic: Dataframe,
+        partitions: Dict[str, Dataframe] = None) -> Tuple[Dataframe, Dataframe]:
     """Extracts event attributes from Atomic
     
     Args:
         atomic - atomic dataframe
+        partitions - relation partitions from `partition_atomic`, computed if not given
 
     Returns:
         dataframe only containing event attributes
     """
+    if partitions is None:
+        partitions = partition_atomic(atomic)
     script_attrs = ['isAfter', 'isBefore', 'HasSubevent']
     dynamic_attrs = ['Causes', 'HinderedBy', 'xReason']
-    script_frame = atomic[~atomic['relation'].isin(script_attrs)]
-    dyna_frame = atomic[~atomic['relation'].isin(dynamic_attrs)]
+    script_frame = _select(atomic, partitions, script_attrs)
+    dyna_frame = _select(atomic, partitions, dynamic_attrs)
 
     return (script_frame, dyna_frame)
 
@@ -135,54 +310,60 @@ def collect_sample(from_head: str,
 
 
 def fill_placeholders(atomic: Dataframe,
-                      columns: List[str] = ['head', 'tail']) -> Dataframe:
+                      columns: List[str] = ['head', 'tail'],
+                      chunk_size: int = 250000,
+                      random_state: int = None) -> Dataframe:
     """Fills placeholder values Person {X, Y, Z} with an arbitrary `pname`
 
     Args:
         atomic - atomic dataframe
         columns - columns to process
+        chunk_size - number of rows processed at once, bounds memory
+        random_state - seed of the name choice, `None` uses the global random state
 
     Returns:
         dataframe with replaced names
     """
     df = atomic
-    names = PNAME_SUB
+    names = list(PNAME_SUB)
     df['origin'] = df['head']
 
-    def fill_obj(row):
-        """Fills ___ placeholder"""
-        if row['relation'] == 'isFilledBy':
-            return row['head'].replace('___', row['tail'])
-        else:
-            return row['head']
-
-    def replace(x: str, placeholder: str, replace_with: str) -> str:
-        """Replaces Person ϵ [X-Z] with natural names"""
-        if isinstance(x, str) and re.search(placeholder, x) is not None:
-            s = re.sub(placeholder, replace_with, x)
-            return s
-        return x
-
+    # do not allow duplicate names
+    patterns = []
+    pick = choice if random_state is None else Random(random_state).choice
     for i in PNAME_PLACEHOLDER_RE:
-        rex = re.compile(i, flags=re.IGNORECASE)
-        name = choice(names)
-
-        for col in columns:
-            df[col] = df[col].apply(
-                lambda x: replace(x, placeholder=rex, replace_with=name))
-
-        # do not allow duplicate names
+        name = pick(names)
+        patterns.append((re.compile(i, flags=re.IGNORECASE), name))
         names.remove(name)
-        re.purge()
 
-    for i, row in df.iterrows():
-        df.loc[i, 'head'] = fill_obj(row)
+    def replace(s: pd.Series) -> pd.Series:
+        """Replaces Person ϵ [X-Z] with natural names, non-strings are kept"""
+        out = s
+        for rex, name in patterns:
+            out = out.str.replace(rex, name, regex=True)
+        return out.where(s.notna() & out.notna(), s)
+
+    for start in range(0, len(df), chunk_size):
+        rows = slice(start, start + chunk_size)
+        for col in columns:
+            j = df.columns.get_loc(col)
+            df.iloc[rows, j] = replace(df.iloc[rows, j]).values
+
+        # fills ___ placeholder with the tail of `isFilledBy` relations
+        chunk = df.iloc[rows]
+        mask = (chunk['relation'] == 'isFilledBy').values
+        heads = chunk['head'].values.copy()
+        heads[mask] = [
+            h.replace('___', t)
+            for h, t in zip(heads[mask], chunk['tail'].values[mask])
+        ]
 
-    # spacy parses recognizes the underscore as a dobj
-    # for coverage i sub the triple underscores with a single one
-    # so if we want to retrieve atomic values with the dp structure
-    # we can collect more candidates for BERT score.
-    df['head'] = df['head'].apply(lambda x: x.replace('___', '_'))
+        # spacy parses recognizes the underscore as a dobj
+        # for coverage i sub the triple underscores with a single one
+        # so if we want to retrieve atomic values with the dp structure
+        # we can collect more candidates for BERT score.
+        df.iloc[rows, df.columns.get_loc('head')] = pd.Series(
+            heads, dtype=object).str.replace('___', '_', regex=False).values
 
     # TODO: can be done after parsing
     # filter remaining ___ placeholder values (they are not important for our dependency_parses
@@ -194,13 +375,24 @@ def fill_placeholders(atomic: Dataframe,
 def parse(atomic: Dataframe,
           col: str,
           parse_type: str,
-          save: bool = True) -> Dataframe:
-    """Apply parse function on atomic heads
+          save: bool = True,
+          save_to: str = None,
+          shard_size: int = 20000,
+          n_process: int = 4,
+          batch_size: int = 256) -> Dataframe:
+    """Apply parse function on atomic heads. Parses are written in fixed-size
+    shards with a manifest, a restarted job resumes after the last completed shard.
+    Dependency parses are stored as columnar `ParseStore` shards, srl parses as pickles.
 
     Args:
         atomic - atomic dataframe
         parse_type - possible parse types: srl, dp
-        save - if true saves dataframe to disk
+        save - if true saves parses to disk
+        save_to - shard directory, defaults to `data/atomic/parse-{parse_type}`
+            for heads and `data/atomic/parse-{col}-{parse_type}` otherwise
+        shard_size - number of unique heads per shard
+        n_process - number of spacy worker processes
+        batch_size - number of heads per spacy or srl batch
 
     Returns:
         dataframe with added parse column
@@ -208,118 +400,210 @@ def parse(atomic: Dataframe,
     assert parse_type in ['srl', 'dp'], 'Parse type supplied not implemented'
     assert col in atomic.columns
 
+    df = atomic
+    # first origin of every unique head, computed once instead of once per head
+    origins = df[df[col].apply(lambda x: isinstance(x, str))].drop_duplicates(
+        col).set_index(col)['origin']
+    texts = origins.index.tolist()
+    origins = origins.tolist()
+    print(f'Start {parse_type} parsing, with {len(texts)} samples.')
+
     if parse_type == 'srl':
-        from src_old.nlp import srl
-        fn = srl
-        del srl
-    elif parse_type == 'dp':
-        from src_old.nlp import dependency_parse as dp
-        fn = dp
-        del dp
+        from src_old.nlp import srl_batch
 
-    df = atomic
-    print(f'Start {parse_type} parsing, with {len(df[col].unique())} samples.')
-    parses = {}
-
-    for i, t in enumerate(tqdm(df[col].unique()), start=0):
-        if isinstance(t, str):
-            origin = df.loc[df[col] == t]['origin'].iloc[0]
-            # pass origin only for dep parse
-            tmp = fn([t, origin])
-        # tmp = fn(t) if isinstance(t, str) else None
-        # dict -> Doc/str: parse
-        if i % 5000 == 0:
-            print('Current sample: ', tmp)
-        parses.update(tmp)
+        def fn(texts: List[str]) -> list:
+            return [
+                p for i in range(0, len(texts), batch_size)
+                for p in srl_batch(texts[i:i + batch_size])
+            ]
+    elif parse_type == 'dp':
+        from src_old.nlp import get_nlp, DEPENDENCY_PIPES
+        nlp = get_nlp(DEPENDENCY_PIPES)
+
+        def fn(texts: List[str]) -> list:
+            return nlp.pipe(texts, n_process=n_process, batch_size=batch_size)
+
+    if save_to is None:
+        name = parse_type if col == 'head' else f'{col}-{parse_type}'
+        save_to = f'{DATA_ROOT}/atomic/parse-{name}'
+    manifest = ShardManifest(save_to,
+                             len(texts),
+                             shard_size,
+                             meta={
+                                 'column': col,
+                                 'parse_type': parse_type,
+                                 'input': content_hash(zip(texts, origins)),
+                                 'storage': 'parse_store'
+                                 if parse_type == 'dp' else 'pickle'
+                             })
+
+    for shard in tqdm(manifest.pending()):
+        bounds = manifest.bounds(shard)
+        if parse_type == 'dp':
+            store = ParseStore.from_docs(fn(texts[bounds]), origins[bounds])
+            print('Current sample: ', store.texts[0], store.sentence(0))
+            if save:
+                store.save(manifest.shard_path(shard, suffix=''))
+                manifest.complete(shard)
+            continue
+
+        # head -> origin & srl parse
+        parses = {}
+        for text, origin, p in zip(texts[bounds], origins[bounds],
+                                   fn(texts[bounds])):
+            parses[text] = {'origin': origin, 'parse': p}
+        print('Current sample: ', next(iter(parses.items())))
+
+        if save:
+            with open(manifest.shard_path(shard), 'wb') as p:
+                pickle.dump(parses, p)
+            manifest.complete(shard)
 
-    if save:
-        with open(f'{DATA_ROOT}/atomic/parse-{parse_type}.pickle', 'wb') as p:
-            pickle.dump(parses, p)
-        # df.to_pickle(f'{DATA_ROOT}/atomic/parse-{parse_type}.pickle')
     return df
 
 
-def create_lookup_dict(dp_parse: str = 'data/atomic/dp.pickle'):
-    with open(dp_parse, 'rb') as p:
-        parses = pickle.load(p)
+def read_parses(path: str) -> Iterator[Tuple[Doc, Dict[str, str]]]:
+    """Streams parses from a single pickle or from a pickle shard directory written by `parse`
+
+    Args:
+        path - pickle file or shard directory
+
+    Returns:
+        iterator over parsed docs and their entries
+    """
+    files = [path]
+    if os.path.isdir(path):
+        files = ShardManifest.open(path).shards()
+    for f in files:
+        with open(f, 'rb') as p:
+            yield from pickle.load(p).items()
 
-    # keys are spacy docs
-    ndict = {}
-    for p, d in parses.items():
-        tmp_verb = []
-        tmp_objs = []
-        atomic_string = d['origin']
-        for t in p:
-            if t.pos == S.VERB:
-                tmp_verb.append(t.lemma_)
-            if 'obj' in t.dep_:
-                tmp_objs.append(t.text)
-        ndict[p] = {
-            'text': atomic_string,
-            'verbs': tmp_verb,
-            'objects': tmp_objs
-        }
 
+def convert_parses(from_pickle: str = 'data/atomic/dp.pickle',
+                   save_to: str = f'{DATA_ROOT}/atomic/parse-dp') -> ParseStore:
+    """Converts pickled dependency parses keyed by spacy docs to a parse store
+
+    Args:
+        from_pickle - path to pickle file or pickle shard directory
+        save_to - directory to save store to
+
+    Returns:
+        parse store
+    """
+    docs, origins = zip(*((doc, entry['origin'])
+                          for doc, entry in read_parses(from_pickle)))
+    store = ParseStore.from_docs(docs, origins)
+    store.save(save_to)
+    return store
+
+
+def lookup_entries(
+        stores: Iterable[ParseStore]) -> Dict[str, Dict[str, List[str]]]:
+    """Collects origin, verb lemmas and objects of every parsed head
+
+    Args:
+        stores - parse stores of atomic heads
+
+    Returns:
+        dict of parsed head text to lookup entry
+    """
+    # keys are parsed head texts
+    ndict = {}
+    for store in stores:
+        verbs = store.gather(store.mask('pos', ['VERB']), 'lemma')
+        obj_deps = [d for d in store.vocab['dep'] if 'obj' in d]
+        objects = store.gather(store.mask('dep', obj_deps), 'word')
+        for text, atomic_string, tmp_verb, tmp_objs in zip(
+                store.texts, store.origins, verbs, objects):
+            ndict[text] = {
+                'text': atomic_string,
+                'verbs': tmp_verb,
+                'objects': tmp_objs
+            }
+    return ndict
+
+
+def create_lookup_dict(dp_parse: str = f'{DATA_ROOT}/atomic/parse-dp'):
+    ndict = lookup_entries(read_parse_stores(dp_parse))
     with open(f'data/atomic/lookup.pickle', 'wb') as p:
         pickle.dump(ndict, p)
 
 
-def count_dict(
-        from_pickle: str) -> tuple[Dict[str, int], Dict[str, List[Doc]]]:
-    """Returns a count dictionary and a reduced dict to parse structure
+def create_lemma_index(
+        lookup: str = 'data/atomic/lookup.pickle',
+        save_to: str = 'data/atomic/lemma_index') -> LemmaIndex:
+    """Builds an inverted index from verb and object lemmas to head ids,
+    so searching does not need a pass over the complete lookup table.
 
     Args:
-        from_pickle: path to pickle file
+        lookup - path to lookup pickle created by `create_lookup_dict`
+        save_to - directory to save index to, if `None` the index is not saved
 
     Returns:
-        - dependency parse structure -> count
-        - dependency parse structure -> list of collected spacy documents"""
-
-    with open(from_pickle, 'rb') as p:
-        # doc -> dep_parse
+        inverted lemma index
+    """
+    with open(lookup, 'rb') as p:
         data = pickle.load(p)
 
-    counter = Counter([parse for parse in data.values()])
-    gatherer = defaultdict(list)
-    for k, v in data.items():
-        gatherer[v].append(k)
+    index = LemmaIndex.from_lookup(data)
+    if save_to is not None:
+        index.save(save_to)
+
+    return index
 
-    return (counter, gatherer)
 
+def count_dict(from_path: str,
+               spill_to: str = None,
+               n_workers: int = 4,
+               top_k: int = 10) -> StructureCounts:
+    """Counts dependency parse structures and gathers their parsed texts,
+    shards are processed in parallel and gathered texts are spilled to disk
+
+    Args:
+        from_path - parse store or shard directory of parse stores
+        spill_to - directory for gathered texts, defaults to `{from_path}/structures`
+        n_workers - number of worker processes
+        top_k - number of most common structures to print
 
-def find_relations(atomic: Dataframe) -> Dataframe:
+    Returns:
+        structure counts, `members(structure)` streams the gathered texts
+    """
+    counts = count_structures(from_path, spill_to, n_workers)
+    for structure, n in counts.top(top_k):
+        print(f'{n:>8} {structure}')
+
+    return counts
+
+
+def find_relations(atomic: Dataframe,
+                   parses: str = f'{DATA_ROOT}/atomic/parse-tail-dp',
+                   col: str = 'tail',
+                   n_workers: int = 4) -> Dataframe:
     """Go through atomic tail parses and extract objects to look up in head
 
     Args:
         atomic - atomic dataframe
+        parses - parse store or shard directory holding parses of `col`
+        col - parsed column
+        n_workers - number of processes extracting shards without saved relation columns
 
     Returns:
-        dataframe with objects and verbs as columns added
+        dataframe with lists of objects (dobj, pobj) and verb lemmas as columns added
     """
-    assert 'tail-dp' in atomic.columns
+    assert col in atomic.columns
     df = atomic
 
-    obj_extraction = []
-    verb_extraction = []
-    for sample in df['tail-dp']:
-        obj_tmp = []
-        verb_tmp = []
-        for parse in sample:
-            if 'dobj' in parse.dep or 'pobj' in parse.dep:
-                obj_tmp.append(parse.text)
-                print(f'Sample found in {sample}: {parse.text}')
-            else:
-                obj_tmp.append(None)
-
-            if 'verb' in parse.tag:
-                verb_tmp.append(None)
-            else:
-                verb_tmp.append(None)
-
-        obj_extraction.append(obj_tmp)
-        verb_extraction.append(verb_tmp)
-
-    df['objects'] = obj_extraction
-    df['verbs'] = verb_extraction
+    relations = relation_frame(parses, n_workers)
+    df['objects'] = df[col].map(relations['objects'])
+    df['verbs'] = df[col].map(relations['verbs'])
 
     return df
+
+
+if __name__ == "__main__":
+    # seeded, a resumed job parses the same heads
+    atomic = fill_placeholders(load_atomic_data(), random_state=42)
+    parse(atomic,
+          'head',
+          'dp',
+          n_process=int(os.environ.get('SLURM_CPUS_PER_TASK', 4)))
@@ -0,0 +1,162 @@
+"""Persistent retrieval cache shared between processes"""
+
+import hashlib
+import os
+import pickle
+import re
+import struct
+from typing import Any, Iterable
+
+import lmdb
+
+from src_old.constants import DATA_ROOT
+
+
+def normalize(utterance: str) -> str:
+    """Normalizes utterance for cache keys"""
+    utterance = utterance.replace('_comma_', ',').lower()
+    return re.sub(r'\s+', ' ', utterance).strip()
+
+
+def knowledge_base_version(paths: Iterable[str]) -> str:
+    """Hashes name, size and modification time of all knowledge base files,
+    so rebuilding any of them results in a new version
+
+    Args:
+        paths - files or directories making up the knowledge base
+
+    Returns:
+        version hash
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(root, f) for root, _, fs in os.walk(path)
+                for f in fs)
+        for f in files:
+            if os.path.exists(f):
+                stat = os.stat(f)
+                h.update(f'{f}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return h.hexdigest()[:16]
+
+
+class RetrievalCache:
+    """Disk-backed LRU cache on top of lmdb, entries are keyed by normalized
+    utterance and knowledge base version. Every access gets a tick, the
+    entry with the oldest tick is evicted once `max_entries` is exceeded.
+    Reads run in read-only transactions, their ticks are kept in memory and
+    written with the next `put`, `flush` or `close`."""
+    def __init__(self,
+                 path: str = f'{DATA_ROOT}/cache/retrieval',
+                 version: str = '',
+                 max_entries: int = 200000,
+                 map_size: int = 2**32,
+                 flush_every: int = 1000):
+        """Opens or creates cache
+
+        Args:
+            path - directory of the lmdb environment
+            version - knowledge base version, see `knowledge_base_version`
+            max_entries - maximum number of cached entries
+            map_size - maximum size of the database in bytes
+            flush_every - number of pending reads after which their ticks are written
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.version = version
+        self.max_entries = max_entries
+        self.map_size = map_size
+        self.flush_every = flush_every
+        self._pid = None
+        # keys read since the last write, in order of access
+        self._touched = {}
+
+    def _open(self):
+        """Opens environment once per process, handles must not cross forks"""
+        if self._pid != os.getpid():
+            self._env = lmdb.open(self.path, map_size=self.map_size, max_dbs=4)
+            self._entries = self._env.open_db(b'entries')
+            self._ticks = self._env.open_db(b'ticks')
+            self._lru = self._env.open_db(b'lru')
+            self._meta = self._env.open_db(b'meta')
+            self._touched = {}
+            self._pid = os.getpid()
+        return self._env
+
+    def _key(self, utterance: str) -> bytes:
+        digest = hashlib.sha1(normalize(utterance).encode('utf8')).hexdigest()
+        return f'{self.version}:{digest}'.encode()
+
+    def _touch(self, txn: lmdb.Transaction, key: bytes):
+        """Moves key to the most recently used position"""
+        tick = struct.unpack('>Q', txn.get(b'tick', b'\0' * 8,
+                                           db=self._meta))[0] + 1
+        # big endian keeps lmdb's byte order equal to numeric order
+        tick = struct.pack('>Q', tick)
+        txn.put(b'tick', tick, db=self._meta)
+        old = txn.get(key, db=self._ticks)
+        if old is not None:
+            txn.delete(old, db=self._lru)
+        txn.put(key, tick, db=self._ticks)
+        txn.put(tick, key, db=self._lru)
+
+    def _flush(self, txn: lmdb.Transaction):
+        """Writes ticks of pending reads, entries evicted in between are skipped"""
+        for key in self._touched:
+            if txn.get(key, db=self._entries) is not None:
+                self._touch(txn, key)
+        self._touched = {}
+
+    def get(self, utterance: str, default: Any = None) -> Any:
+        """Returns cached value of utterance or default"""
+        env = self._open()
+        key = self._key(utterance)
+        with env.begin() as txn:
+            value = txn.get(key, db=self._entries)
+        if value is None:
+            return default
+        # moves key to the end of pending reads
+        self._touched.pop(key, None)
+        self._touched[key] = None
+        if len(self._touched) >= self.flush_every:
+            self.flush()
+        return pickle.loads(value)
+
+    def put(self, utterance: str, value: Any):
+        """Caches value of utterance and evicts least recently used entries"""
+        env = self._open()
+        key = self._key(utterance)
+        with env.begin(write=True) as txn:
+            self._flush(txn)
+            txn.put(key, pickle.dumps(value), db=self._entries)
+            self._touch(txn, key)
+            n = txn.stat(self._entries)['entries']
+            cursor = txn.cursor(db=self._lru)
+            while n > self.max_entries and cursor.first():
+                tick, old = cursor.item()
+                cursor.delete()
+                txn.delete(old, db=self._ticks)
+                txn.delete(old, db=self._entries)
+                n -= 1
+
+    def flush(self):
+        """Writes ticks of pending reads in one transaction"""
+        if not self._touched:
+            return
+        env = self._open()
+        with env.begin(write=True) as txn:
+            self._flush(txn)
+
+    def close(self):
+        """Flushes pending reads and closes the environment of this process"""
+        if self._pid == os.getpid():
+            self.flush()
+            self._env.close()
+            self._pid = None
+
+    def __len__(self) -> int:
+        env = self._open()
+        with env.begin() as txn:
+            return txn.stat(self._entries)['entries']
@@ -0,0 +1,146 @@
+"""Cached columnar builds of the knowledge bases as Arrow files"""
+
+from functools import partial
+import hashlib
+import inspect
+import json
+import os
+from typing import Callable, List, Mapping
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+Dataframe = pd.DataFrame
+
+# bumped when shared build helpers such as `encode` change
+BUILD_VERSION = '1'
+
+
+def file_hash(path: str, chunk_size: int = 2**20) -> str:
+    """Hashes file contents"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _fingerprints(sources: List[str], known: Mapping[str, dict]) -> dict:
+    """Fingerprints sources, the content is only hashed again if size or
+    modification time differ from the known fingerprint"""
+    res = {}
+    for source in sources:
+        stat = os.stat(source)
+        old = known.get(source, {})
+        if (old.get('size'), old.get('mtime')) == (stat.st_size,
+                                                   stat.st_mtime_ns):
+            res[source] = old
+        else:
+            res[source] = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'hash': file_hash(source)
+            }
+    return res
+
+
+def encode(df: Dataframe,
+           categorical: List[str] = None,
+           max_ratio: float = 0.5) -> Dataframe:
+    """Dictionary encodes string columns as pandas categoricals
+
+    Args:
+        df - dataframe to encode
+        categorical - columns to encode, defaults to all string columns with
+            at most `max_ratio` unique values per row
+        max_ratio - ratio of unique values below which a column is encoded
+
+    Returns:
+        dataframe with categorical columns
+    """
+    if categorical is None:
+        categorical = [
+            c for c in df.columns
+            if (pd.api.types.is_object_dtype(df[c])
+                or pd.api.types.is_string_dtype(df[c]))
+            and df[c].nunique() <= max_ratio * len(df)
+        ]
+    return df.astype({c: 'category' for c in categorical})
+
+
+def build_key(build: Callable, version: str = '') -> str:
+    """Hashes name and source code of a build function and a version, so a
+    changed build or changed read options invalidate cached builds
+
+    Args:
+        build - build function
+        version - bumped when helpers the build calls change
+
+    Returns:
+        build key
+    """
+    h = hashlib.sha1(version.encode('utf8'))
+    if isinstance(build, partial):
+        h.update(repr((build.args, sorted(build.keywords.items()))).encode('utf8'))
+        build = build.func
+    h.update(f'{build.__module__}.{build.__qualname__}'.encode('utf8'))
+    try:
+        h.update(inspect.getsource(build).encode('utf8'))
+    except (OSError, TypeError):
+        pass
+    return h.hexdigest()
+
+
+def load_cached(sources: List[str],
+                save_to: str,
+                build: Callable[[List[str]], Dataframe],
+                columns: List[str] = None,
+                version: str = BUILD_VERSION) -> Dataframe:
+    """Loads a knowledge base from its columnar build, the build is only
+    redone if the content of a source file or the build function changed.
+    The Arrow file is uncompressed and read through a memory map, only the
+    requested columns are copied into the dataframe. Dictionary encoded
+    columns are loaded as categoricals.
+
+    Args:
+        sources - source files of the knowledge base
+        save_to - directory holding `data.arrow` and `sources.json`
+        build - creates the dataframe from source files
+        columns - columns to load, defaults to all
+        version - build version, see `build_key`
+
+    Returns:
+        knowledge base dataframe
+    """
+    data = f'{save_to}/data.arrow'
+    manifest = f'{save_to}/sources.json'
+    sources = sorted(sources)
+    key = build_key(build, version)
+
+    known = {'build': None, 'sources': {}}
+    if os.path.exists(manifest) and os.path.exists(data):
+        with open(manifest, 'r') as f:
+            known = json.load(f)
+        if 'sources' not in known:
+            # manifests written before builds were keyed
+            known = {'build': None, 'sources': known}
+    fingerprints = _fingerprints(sources, known['sources'])
+
+    hashes = lambda x: {k: v['hash'] for k, v in x.items()}
+    if key != known['build'] or hashes(fingerprints) != hashes(known['sources']):
+        print(f'Building {data} from {len(sources)} source files')
+        os.makedirs(save_to, exist_ok=True)
+        tmp = f'{data}.tmp'
+        feather.write_feather(pa.Table.from_pandas(build(sources)),
+                              tmp,
+                              compression='uncompressed')
+        os.replace(tmp, data)
+
+    current = {'build': key, 'sources': fingerprints}
+    if current != known:
+        with open(manifest, 'w') as f:
+            json.dump(current, f)
+
+    return feather.read_table(data, columns=columns,
+                              memory_map=True).to_pandas()
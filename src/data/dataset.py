@@ -11,20 +11,28 @@ create a set of possible datapoints by filtering atomic based on nouns and verbs
 
 """
 
+import ast
+import os
 from dataclasses import dataclass, field
+import json
+import pickle
 from pprint import pprint
+import re
 from typing import List, NamedTuple, Tuple, Union, Dict
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
 import spacy
 from spacy import displacy
 from spacy.language import Language
 from spacy.tokens.doc import Doc
 
-from multiprocess.pool import AsyncResult
 from tqdm import tqdm
 
-from src_old.utils import multiprocess, read_tsv
+from src_old.data.relation_store import InvertedIndex, StringTable, gather_ranges
+from src_old.data.shards import ShardManifest, content_hash
+from src_old.utils import read_tsv
 # from src_old.data.preprocessing import social_chem
 
 # dtypes used in this module
@@ -75,86 +83,165 @@ def load_social_chem(
     return read_tsv(path)[social_chem_cols]
 
 
-def create_action_dataset() -> Tuple[pd.DataFrame]:
-    """Create dataset from `social chemistry` actions with `atomic` knowledge
+def read_action_shards(path: str) -> Dict[str, List[Token]]:
+    """Reads verb tokens of all completed action shards
+
+    Args:
+        path - shard directory written by `create_action_dataset`
+
+    Returns:
+        mapping from action to its verb tokens
+    """
+    res = {}
+    for f in ShardManifest.open(path).shards():
+        with open(f, 'rb') as p:
+            res.update({
+                k: [Token(*t) for t in v]
+                for k, v in pickle.load(p).items()
+            })
+    return res
+
+
+def create_action_dataset(path: str = 'data/processed/social_chem_agg.tsv',
+                          save_to: str = 'data/sc_processed',
+                          shard_size: int = 20000,
+                          n_process: int = 4,
+                          batch_size: int = 256,
+                          filter_tag: str = 'VERB') -> pd.DataFrame:
+    """Create dataset from `social chemistry` actions with `atomic` knowledge.
+    Every unique action is tagged once, tokens are written in shards with a
+    manifest so a restarted job resumes after the last completed shard.
+
+    Args:
+        path - social chemistry tsv file
+        save_to - shard directory
+        shard_size - number of unique actions per shard
+        n_process - number of spacy worker processes
+        batch_size - number of actions per spacy batch
+        filter_tag - coarse POS tag of kept tokens
 
     Returns:
         dataframe holding the union of actions and knowledge
     """
-    nlp: Language = spacy.load(
-        'en_core_web_lg')  # loads large spacy model for tagging and parsing
-    sc_data = pd.read_csv('data/processed/social_chem_agg.tsv',
-                          sep='\t',
-                          encoding='utf8')
-    sc_actions = sc_data['action']
-
-    # atomic_data = load_atomic()
-    # atomic_actions = atomic_data['prefix']
-
-    def process_actions(doc: str, filter_tag: str = 'VERB') -> List[Token]:
-        doc = nlp(doc)
-        if doc.has_annotation('TAG'):
-            return [
-                Token(token.lemma_, token.pos_) for token in doc
-                if token.pos_ == filter_tag
-            ]
-        else:
-            return []
-
-    sc_actions = sc_actions.apply(lambda x: process_actions(x))
-    # lemmatize for verb overlap
-    # atomic_actions = atomic_actions.apply(lambda x: [t.lemma_ for t in nlp(' '.join(eval(x)))])
-
-    sc_data['extracted_actions'] = sc_actions
-    # atomic_data['prefix'] = atomic_actions
-
-    print('Saving data')
-    # atomic_data.to_csv('data/atomic_processed.tsv', sep='\t', encoding='utf8')
-    sc_data.to_csv('data/sc_processed.tsv', sep='\t', encoding='utf8')
-    print('Saved frames')
-
-    return sc_data  #(atomic_data, sc_data)
-
-
-def retrieve_verb_overlap(d1: DataFrame,
-                          d2: DataFrame,
-                          multiprocessing: bool = True) -> AsyncResult:
-    atomic_cols = [
-        'oEffect', 'oReact', 'oWant', 'xAttr', 'xEffect', 'xIntent', 'xNeed',
-        'xReact', 'xWant', 'prefix'
-    ]
+    sc_data = pd.read_csv(path, sep='\t', encoding='utf8')
+    actions = sc_data['action'].dropna().unique().tolist()
+    print(f'Tagging {len(actions)} unique of {len(sc_data)} actions')
+
+    manifest = ShardManifest(save_to,
+                             len(actions),
+                             shard_size,
+                             meta={
+                                 'source': path,
+                                 'filter_tag': filter_tag,
+                                 'input': content_hash(actions)
+                             })
+    if not manifest.done:
+        from src_old.nlp import get_nlp, LEMMA_PIPES
+        # parser and ner are not needed for coarse POS tags and lemmas
+        nlp: Language = get_nlp(LEMMA_PIPES)
+
+    for shard in tqdm(manifest.pending()):
+        texts = actions[manifest.bounds(shard)]
+        docs = nlp.pipe(texts, n_process=n_process, batch_size=batch_size)
+        # plain tuples keep shards readable independent of this module
+        tokens = {
+            text: [(token.lemma_, token.pos_) for token in doc
+                   if token.pos_ == filter_tag]
+            for text, doc in zip(texts, docs)
+        }
+        with open(manifest.shard_path(shard), 'wb') as p:
+            pickle.dump(tokens, p)
+        manifest.complete(shard)
+
+    tokens = read_action_shards(save_to)
+    sc_data['extracted_actions'] = sc_data['action'].map(
+        lambda x: tokens.get(x, []))
+    return sc_data
+
+
+def parse_list(x: Union[str, list]) -> list:
+    """Parses a stringified list column entry without `eval`"""
+    if isinstance(x, np.ndarray):
+        # list columns are read from parquet as arrays
+        return x.tolist()
+    if not isinstance(x, str):
+        return x if isinstance(x, list) else []
+    try:
+        return json.loads(x)
+    except json.JSONDecodeError:
+        return ast.literal_eval(x)
+
+
+def action_lemmas(x: Union[str, List[Token]]) -> List[str]:
+    """Lemmas of extracted actions, stringified tokens are read with a regex"""
+    if isinstance(x, str):
+        return [m[1] for m in re.findall(r"lemma=(['\"])(.*?)\1", x)]
+    return [t.lemma for t in x]
+
+
+def _explode(lists: pd.Series) -> DataFrame:
+    """Row position and value of every list element, duplicates within a row are dropped"""
+    exploded = pd.Series(lists.values).explode().dropna()
+    return DataFrame({
+        'row': exploded.index.values,
+        'value': exploded.values
+    }).drop_duplicates()
+
+
+def verb_index(atomic: DataFrame, column: str = 'prefix') -> InvertedIndex:
+    """Builds an inverted index from lemma to atomic row positions
+
+    Args:
+        atomic - atomic dataframe
+        column - column holding lists of lemmas
 
-    sc_actions = d1['extracted_actions']
-
-    def search(partition: DataFrame, partition_id: int) -> DataFrame:
-        """Search for overlap in both dataframes"""
-        df = []
-        for i, sca in enumerate(sc_actions):
-            tmp_dict = {k: [] for k in atomic_data.columns}
-            for _, a in partition.iterrows():
-                for s in eval(sca):
-                    if s.lemma in a['prefix']:
-                        for k in tmp_dict.keys():
-                            tmp_dict[k].append(a[k])
-            tmp_dict['id'] = i  # add id to map back to dataset
-            df.append(tmp_dict)
-
-        df = pd.DataFrame(df)
-        df.to_csv(f'/data/tmp/verb_{partition_id}.tsv',
-                  sep='\t',
-                  encoding='utf8')  # save intermediate repr
-        return df
-
-    if multiprocessing:
-        atomic_data = d2[atomic_cols]
-        split_val = len(atomic_data) // 4
-        splits = [
-            pd.DataFrame(atomic_data.iloc[i - split_val:i])
-            for i in range(split_val, split_val * 5, split_val)
-        ]
-        iters = iter(zip(splits, range(1, 5)))
-        res = multiprocess(search, iters)
-        return res
+    Returns:
+        inverted index of lemma to row positions
+    """
+    df = _explode(atomic[column].map(parse_list))
+    codes, keys = pd.factorize(df['value'])
+    # stable sort keeps row positions ascending within a lemma
+    order = np.argsort(codes, kind='stable')
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=len(keys)), out=offsets[1:])
+    return InvertedIndex(StringTable.from_strings(keys), offsets,
+                         df['row'].values[order].astype(np.int64))
+
+
+def retrieve_verb_overlap(
+        d1: DataFrame,
+        d2: DataFrame,
+        save_to: str = 'data/verb_overlap.npz') -> sparse.csr_matrix:
+    """Matches social chemistry actions with atomic rows sharing a verb lemma
+    through a hash join on an inverted lemma index
+
+    Args:
+        d1 - social chemistry dataframe with `extracted_actions`
+        d2 - atomic dataframe with lemma lists in `prefix`
+        save_to - path to save the match matrix to, if `None` it is not saved
+
+    Returns:
+        sparse action x atomic row matrix holding the number of shared verbs
+    """
+    index = verb_index(d2)
+    actions = _explode(d1['extracted_actions'].map(action_lemmas))
+
+    keys = pd.Index(list(index.keys)).get_indexer(actions['value'])
+    found = keys >= 0
+    keys = keys[found]
+    positions = gather_ranges(index.offsets, keys)
+    lengths = index.offsets[keys + 1] - index.offsets[keys]
+
+    matches = sparse.csr_matrix(
+        (np.ones(len(positions), dtype=np.int32),
+         (np.repeat(actions['row'].values[found], lengths),
+          index.ids[positions])),
+        shape=(len(d1), len(d2)))
+    matches.sum_duplicates()
+
+    if save_to is not None:
+        sparse.save_npz(save_to, matches)
+    return matches
 
 
 def unify_dataframes(dataframes: List[str]):
@@ -166,32 +253,97 @@ def unify_dataframes(dataframes: List[str]):
         './data/tmp/complete_verb_frame.tsv', encoding='utf8', sep='\t')
 
 
-def merge_verb_data():
-    atomic_cols = [
-        'oEffect', 'oReact', 'oWant', 'xAttr', 'xEffect', 'xIntent', 'xNeed',
-        'xReact', 'xWant', 'prefix'
-    ]
-    social_chem = pd.read_csv('data/sc_processed.tsv',
-                              sep='\t',
-                              encoding='utf8',
-                              index_col='Unnamed: 0')
-    verb_frame = pd.read_csv('data/tmp/complete_verb_frame.tsv',
-                             sep='\t',
-                             encoding='utf8')
-    candidate_df = []
-
-    for i, _ in social_chem.iterrows():
-        tmp = {k: [] for k in atomic_cols}
-        for _, a in verb_frame[verb_frame['id'] == i].iterrows():
-            for k in tmp.keys():
-                tmp[k].extend(eval(a[k]))
-
-        candidate_df.append(tmp)
-
-    df = pd.DataFrame(candidate_df)
-    df.to_csv('data/tmp/canditate.tsv', sep='\t', encoding='utf8', index=None)
-
-    # pd.merge(social_chem, df).to_csv('data/tmp/verbs.tsv', sep='\t', encoding='utf8')
+def to_list_columns(df: DataFrame, columns: List[str]) -> DataFrame:
+    """Parses stringified list columns once into native lists, so they can be
+    stored as typed list columns in Parquet
+
+    Args:
+        df - dataframe with stringified list columns
+        columns - columns to parse
+
+    Returns:
+        dataframe with list columns
+    """
+    return df.assign(**{c: df[c].map(parse_list) for c in columns})
+
+
+ATOMIC_LIST_COLUMNS = [
+    'oEffect', 'oReact', 'oWant', 'xAttr', 'xEffect', 'xIntent', 'xNeed',
+    'xReact', 'xWant', 'prefix'
+]
+
+
+def load_atomic_lists(
+        path: str = 'data/processed/v4_atomic_all.tsv',
+        save_to: str = 'data/processed/v4_atomic_all.parquet') -> DataFrame:
+    """Loads the atomic list columns from parquet, they are parsed from the
+    tsv file and saved on first use
+
+    Args:
+        path - atomic tsv file with stringified list columns
+        save_to - parquet file holding native list columns
+
+    Returns:
+        dataframe with list columns
+    """
+    if not os.path.exists(save_to):
+        print(f'Converting {path} to {save_to}')
+        atomic = to_list_columns(load_atomic(path)[ATOMIC_LIST_COLUMNS],
+                                 ATOMIC_LIST_COLUMNS)
+        atomic.reset_index(drop=True).to_parquet(save_to, index=False)
+    return pd.read_parquet(save_to, columns=ATOMIC_LIST_COLUMNS)
+
+
+def merge_verb_data(
+        matches: Union[str, sparse.spmatrix] = 'data/verb_overlap.npz',
+        atomic: DataFrame = None,
+        save_to: str = 'data/tmp/candidates.parquet') -> DataFrame:
+    """Collects the atomic knowledge of all rows matched by a social
+    chemistry action in one explode and groupby pass
+
+    Args:
+        matches - action x atomic row matrix from `retrieve_verb_overlap`
+        atomic - atomic dataframe, defaults to `load_atomic_lists`
+        save_to - parquet file to save candidates to, if `None` they are not saved
+
+    Returns:
+        dataframe with one row per action holding the concatenated lists of
+        every atomic column, in atomic row order
+    """
+    atomic_cols = ATOMIC_LIST_COLUMNS
+    if isinstance(matches, str):
+        matches = sparse.load_npz(matches)
+    if atomic is None:
+        atomic = load_atomic_lists()
+    # stringified lists are parsed once per atomic row, not once per match
+    atomic = to_list_columns(atomic, atomic_cols)
+
+    # csr keeps matched rows sorted by action and atomic row
+    matches = sparse.csr_matrix(matches)
+    matches.sort_indices()
+    actions = np.repeat(np.arange(matches.shape[0]), np.diff(matches.indptr))
+    rows = matches.indices.astype(np.int64)
+
+    candidate_df = {}
+    for k in atomic_cols:
+        # list elements of every atomic row, row `r` is `offsets[r]:offsets[r + 1]`
+        lengths = atomic[k].map(len).values
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # empty lists explode to a single missing value
+        exploded = pd.Series(atomic[k].values).explode().values
+        values = exploded[np.repeat(lengths > 0, np.maximum(lengths, 1))]
+
+        matched = pd.Series(values[gather_ranges(offsets, rows)])
+        owner = np.repeat(actions, lengths[rows])
+        candidate_df[k] = matched.groupby(owner, sort=True).agg(list)
+
+    df = DataFrame(candidate_df).reindex(range(matches.shape[0])).rename_axis(None)
+    df = df.apply(lambda c: c.map(lambda x: x if isinstance(x, list) else []))
+    if save_to is not None:
+        df.to_parquet(save_to, index=False)
+
+    return df
 
 
 @dataclass
@@ -0,0 +1,362 @@
+"""Precomputed BERTScore token embeddings of Atomic heads"""
+
+from collections import defaultdict
+import os
+from typing import List, Sequence, Tuple
+
+from bert_score import BERTScorer
+from bert_score.utils import get_bert_embedding
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from src_old.constants import DATA_ROOT
+from src_old.data.atomic import LemmaIndex
+from src_old.data.relation_store import gather_ranges
+
+# normalized token embeddings and weights of a single sentence
+Embedding = Tuple[np.ndarray, np.ndarray]
+
+
+def idf_weights(scorer: BERTScorer) -> defaultdict:
+    """Returns the idf weights `BERTScorer.score` uses for its scorer"""
+    if scorer.idf:
+        return scorer._idf_dict
+    idf_dict = defaultdict(lambda: 1.0)
+    idf_dict[scorer._tokenizer.sep_token_id] = 0
+    idf_dict[scorer._tokenizer.cls_token_id] = 0
+    return idf_dict
+
+
+def embed(sentences: List[str],
+          scorer: BERTScorer,
+          batch_size: int = 64) -> List[Embedding]:
+    """Embeds sentences the same way `BERTScorer.score` does
+
+    Args:
+        sentences - sentences to embed
+        scorer - scorer holding model, tokenizer and idf weights
+        batch_size - batch size for the model
+
+    Returns:
+        list of L2-normalized token embeddings and token weights per sentence,
+        special tokens keep a weight of 0 but take part in greedy matching
+    """
+    with torch.no_grad():
+        embs, masks, idf = get_bert_embedding(sentences,
+                                              scorer._model,
+                                              scorer._tokenizer,
+                                              idf_weights(scorer),
+                                              batch_size=batch_size,
+                                              device=scorer.device)
+    embs = embs / torch.norm(embs, dim=-1, keepdim=True)
+    lens = masks.sum(dim=1).tolist()
+    embs = embs.cpu().numpy()
+    idf = idf.cpu().numpy()
+
+    return [(e[:n], w[:n]) for e, w, n in zip(embs, idf, lens)]
+
+
+def pool(embedding: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Weighted mean pooling of token embeddings, L2-normalized"""
+    pooled = weights.astype(np.float32) @ embedding.astype(np.float32)
+    return pooled / np.linalg.norm(pooled)
+
+
+class HeadEmbeddings:
+    """Token embeddings of all heads in one flat float16 matrix, the tokens of
+    head `i` are the rows `offsets[i]:offsets[i + 1]`"""
+    def __init__(self, embeddings: np.ndarray, weights: np.ndarray,
+                 offsets: np.ndarray):
+        self.embeddings = embeddings
+        self.weights = weights
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @classmethod
+    def from_texts(cls,
+                   texts: Sequence[str],
+                   scorer: BERTScorer,
+                   chunk_size: int = 1024,
+                   batch_size: int = 64) -> 'HeadEmbeddings':
+        """Embeds all heads
+
+        Args:
+            texts - heads to embed, ids are positions
+            scorer - scorer holding model, tokenizer and idf weights
+            chunk_size - number of heads padded together
+            batch_size - batch size for the model
+
+        Returns:
+            head embeddings
+        """
+        embeddings = []
+        weights = []
+        lengths = []
+        for i in tqdm(range(0, len(texts), chunk_size)):
+            for e, w in embed(list(texts[i:i + chunk_size]), scorer,
+                              batch_size):
+                embeddings.append(e.astype(np.float16))
+                weights.append(w.astype(np.float32))
+                lengths.append(len(e))
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(np.concatenate(embeddings), np.concatenate(weights),
+                   offsets)
+
+    def extend(self, other: 'HeadEmbeddings') -> 'HeadEmbeddings':
+        """Appends heads of other, their ids are shifted by `len(self)`"""
+        return HeadEmbeddings(
+            np.concatenate([self.embeddings, other.embeddings]),
+            np.concatenate([self.weights, other.weights]),
+            np.concatenate([self.offsets, other.offsets[1:] + self.offsets[-1]]))
+
+    def greedy_f1(self, query: np.ndarray, query_weights: np.ndarray,
+                  ids: Sequence[int]) -> np.ndarray:
+        """Greedy matching F1 between a query and cached heads, as in BERTScore
+        with heads as candidates and the query as reference
+
+        Args:
+            query - normalized token embeddings of the query
+            query_weights - token weights of the query
+            ids - head ids to score
+
+        Returns:
+            F1 score per head id, without baseline rescaling
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = gather_ranges(self.offsets, ids)
+        lengths = self.offsets[ids + 1] - self.offsets[ids]
+        starts = np.cumsum(lengths) - lengths
+
+        tokens = self.embeddings[positions].astype(np.float32)
+        weights = self.weights[positions]
+        sim = tokens @ query.astype(np.float32).T
+
+        # precision: every head token is matched to its closest query token
+        precision = np.add.reduceat(sim.max(axis=1) * weights, starts)
+        precision /= np.add.reduceat(weights, starts)
+        # recall: every query token is matched to its closest head token
+        recall = np.maximum.reduceat(sim, starts, axis=0) @ query_weights
+        recall /= query_weights.sum()
+
+        return 2 * precision * recall / (precision + recall)
+
+    def pooled(self, chunk_size: int = 65536) -> np.ndarray:
+        """Pools token embeddings of every head into one normalized vector
+
+        Args:
+            chunk_size - number of heads pooled at once
+
+        Returns:
+            float16 matrix with one row per head
+        """
+        out = np.empty((len(self), self.embeddings.shape[1]), dtype=np.float16)
+        for i in range(0, len(self), chunk_size):
+            ids = np.arange(i, min(i + chunk_size, len(self)))
+            start, end = self.offsets[ids[0]], self.offsets[ids[-1] + 1]
+            tokens = self.embeddings[start:end].astype(np.float32)
+            tokens *= self.weights[start:end, None]
+            pooled = np.add.reduceat(tokens, self.offsets[ids] - start)
+            pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+            out[ids] = pooled
+        return out
+
+    def save(self, path: str = f'{DATA_ROOT}/atomic/head_embeddings'):
+        os.makedirs(path, exist_ok=True)
+        np.save(f'{path}/embeddings.npy', self.embeddings)
+        np.save(f'{path}/weights.npy', self.weights)
+        np.save(f'{path}/offsets.npy', self.offsets)
+
+    @classmethod
+    def load(cls,
+             path: str = f'{DATA_ROOT}/atomic/head_embeddings',
+             mmap_mode: str = 'r') -> 'HeadEmbeddings':
+        return cls(np.load(f'{path}/embeddings.npy', mmap_mode=mmap_mode),
+                   np.load(f'{path}/weights.npy', mmap_mode=mmap_mode),
+                   np.load(f'{path}/offsets.npy', mmap_mode=mmap_mode))
+
+
+class IVFIndex:
+    """Inverted file index for approximate nearest neighbour search over pooled
+    head embeddings. Vectors are stored grouped by their closest centroid, list
+    `c` holds the rows `offsets[c]:offsets[c + 1]`"""
+    def __init__(self, centroids: np.ndarray, ids: np.ndarray,
+                 offsets: np.ndarray, vectors: np.ndarray):
+        self.centroids = centroids
+        self.ids = ids
+        self.offsets = offsets
+        self.vectors = vectors
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @staticmethod
+    def _assign(vectors: np.ndarray,
+                centroids: np.ndarray,
+                chunk_size: int = 65536) -> np.ndarray:
+        """Assigns every vector to its most similar centroid"""
+        return np.concatenate([
+            np.argmax(vectors[i:i + chunk_size].astype(np.float32)
+                      @ centroids.T,
+                      axis=1) for i in range(0, len(vectors), chunk_size)
+        ])
+
+    @classmethod
+    def from_vectors(cls,
+                     vectors: np.ndarray,
+                     n_lists: int = 1024,
+                     n_iter: int = 10,
+                     n_train: int = 131072,
+                     seed: int = 42) -> 'IVFIndex':
+        """Trains centroids with spherical k-means and fills the inverted lists
+
+        Args:
+            vectors - normalized vectors, ids are positions
+            n_lists - number of inverted lists
+            n_iter - k-means iterations
+            n_train - number of vectors sampled to train centroids
+            seed - random seed for sampling
+
+        Returns:
+            ivf index
+        """
+        rng = np.random.default_rng(seed)
+        n_lists = min(n_lists, len(vectors))
+        train = vectors[rng.choice(len(vectors),
+                                   min(n_train, len(vectors)),
+                                   replace=False)].astype(np.float32)
+        centroids = train[rng.choice(len(train), n_lists, replace=False)]
+
+        for _ in tqdm(range(n_iter)):
+            assignment = cls._assign(train, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, train)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # empty lists keep their old centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12),
+                                 centroids)
+
+        assignment = cls._assign(vectors, centroids)
+        ids = np.argsort(assignment, kind='stable')
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=offsets[1:])
+
+        return cls(centroids.astype(np.float32), ids,
+                   offsets, vectors[ids].astype(np.float16))
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray) -> 'IVFIndex':
+        """Assigns new vectors to the trained centroids and inserts them
+
+        Args:
+            vectors - normalized vectors
+            ids - head ids of vectors
+
+        Returns:
+            index holding old and new vectors
+        """
+        n_lists = len(self.centroids)
+        assignment = np.concatenate([
+            np.repeat(np.arange(n_lists), np.diff(self.offsets)),
+            self._assign(vectors, self.centroids)
+        ])
+        # stable sort keeps old vectors in front within a list
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=offsets[1:])
+        return IVFIndex(
+            self.centroids,
+            np.concatenate([self.ids, ids])[order], offsets,
+            np.concatenate([self.vectors,
+                            vectors.astype(np.float16)])[order])
+
+    def search(self,
+               query: np.ndarray,
+               k: int = 10,
+               n_probe: int = 8) -> Tuple[np.ndarray, np.ndarray]:
+        """Approximate top-k search
+
+        Args:
+            query - normalized query vector
+            k - number of neighbours
+            n_probe - number of inverted lists to scan
+
+        Returns:
+            ids and cosine similarities of the top-k heads, best first
+        """
+        query = query.astype(np.float32)
+        n_probe = min(n_probe, len(self.centroids))
+        probe = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        positions = gather_ranges(self.offsets, probe)
+        scores = self.vectors[positions].astype(np.float32) @ query
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k] if k > 0 else positions[:0]
+        top = top[np.argsort(-scores[top])]
+        return self.ids[positions[top]], scores[top]
+
+    def save(self, path: str = f'{DATA_ROOT}/atomic/ivf_index'):
+        os.makedirs(path, exist_ok=True)
+        np.save(f'{path}/centroids.npy', self.centroids)
+        np.save(f'{path}/ids.npy', self.ids)
+        np.save(f'{path}/offsets.npy', self.offsets)
+        np.save(f'{path}/vectors.npy', self.vectors)
+
+    @classmethod
+    def load(cls,
+             path: str = f'{DATA_ROOT}/atomic/ivf_index',
+             mmap_mode: str = 'r') -> 'IVFIndex':
+        return cls(np.load(f'{path}/centroids.npy'),
+                   np.load(f'{path}/ids.npy', mmap_mode=mmap_mode),
+                   np.load(f'{path}/offsets.npy', mmap_mode=mmap_mode),
+                   np.load(f'{path}/vectors.npy', mmap_mode=mmap_mode))
+
+
+def build_ivf_index(embeddings: str = f'{DATA_ROOT}/atomic/head_embeddings',
+                    save_to: str = f'{DATA_ROOT}/atomic/ivf_index',
+                    n_lists: int = 1024) -> IVFIndex:
+    """Builds ivf index over pooled head embeddings
+
+    Args:
+        embeddings - directory of head embeddings created by `build_head_embeddings`
+        save_to - directory to save index to
+        n_lists - number of inverted lists
+
+    Returns:
+        ivf index
+    """
+    index = IVFIndex.from_vectors(
+        HeadEmbeddings.load(embeddings).pooled(), n_lists)
+    if save_to is not None:
+        index.save(save_to)
+    return index
+
+
+def build_head_embeddings(
+        index: str = f'{DATA_ROOT}/atomic/lemma_index',
+        save_to: str = f'{DATA_ROOT}/atomic/head_embeddings',
+        model_type: str = 'distilbert-base-uncased') -> HeadEmbeddings:
+    """Offline job embedding all heads of the lemma index once
+
+    Args:
+        index - directory of lemma index created by `create_lemma_index`
+        save_to - directory to save embeddings to
+        model_type - model used by the retrieval scorer
+
+    Returns:
+        head embeddings
+    """
+    texts = list(LemmaIndex.load(index).texts)
+    scorer = BERTScorer(model_type=model_type, lang='en')
+    embeddings = HeadEmbeddings.from_texts(texts, scorer)
+    if save_to is not None:
+        embeddings.save(save_to)
+    return embeddings
+
+
+if __name__ == "__main__":
+    build_head_embeddings()
+    build_ivf_index()
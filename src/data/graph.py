@@ -0,0 +1,227 @@
+"""Atomic as a graph over integer node ids for multi-hop expansion"""
+
+import os
+from typing import Iterable, List, NamedTuple, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from src_old.constants import DATA_ROOT
+from src_old.data.atomic import load_atomic_data
+from src_old.data.relation_store import StringTable, gather_ranges
+
+Dataframe = pd.DataFrame
+
+
+class Adjacency(NamedTuple):
+    """CSR adjacency, the edges of node `n` are `offsets[n]:offsets[n + 1]`"""
+    offsets: np.ndarray
+    relation_ids: np.ndarray
+    neighbours: np.ndarray
+
+
+class Expansion(NamedTuple):
+    """Edges traversed by a batched bfs, one entry per edge"""
+    batch: np.ndarray
+    source: np.ndarray
+    relation: np.ndarray
+    target: np.ndarray
+    hop: np.ndarray
+
+
+class AtomicGraph:
+    """Heads and tails of Atomic share one node table, so a tail that also
+    occurs as head links to its relations. `forward` maps heads to tails,
+    `reverse` maps tails back to the heads they are attached to."""
+    def __init__(self, nodes: StringTable, relations: StringTable,
+                 forward: Adjacency, reverse: Adjacency):
+        self.nodes = nodes
+        self.relations = relations
+        self.forward = forward
+        self.reverse = reverse
+
+    @staticmethod
+    def _csr(n_nodes: int, sources: np.ndarray, relation_ids: np.ndarray,
+             targets: np.ndarray) -> Adjacency:
+        # stable sort keeps the original row order within a node
+        order = np.argsort(sources, kind='stable')
+        offsets = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=n_nodes), out=offsets[1:])
+        return Adjacency(offsets, relation_ids[order].astype(np.int16),
+                         targets[order].astype(np.int32))
+
+    @classmethod
+    def from_frame(cls,
+                   atomic: Dataframe,
+                   head_col: str = 'head',
+                   relation_col: str = 'relation',
+                   tail_col: str = 'tail',
+                   drop: Sequence[str] = ('none', )) -> 'AtomicGraph':
+        """Builds graph from atomic dataframe
+
+        Args:
+            atomic - atomic dataframe
+            head_col - column holding heads
+            relation_col - column holding relations
+            tail_col - column holding tails
+            drop - tails that do not become nodes
+
+        Returns:
+            atomic graph
+        """
+        df = atomic[atomic[head_col].notna() & atomic[tail_col].notna()
+                    & atomic[relation_col].notna()]
+        df = df[~df[tail_col].isin(drop)]
+        # heads and tails are factorized together to share node ids
+        node_ids, nodes = pd.factorize(
+            pd.concat([df[head_col].astype(object),
+                       df[tail_col].astype(object)],
+                      ignore_index=True))
+        heads, tails = node_ids[:len(df)], node_ids[len(df):]
+        relation_ids, relations = pd.factorize(df[relation_col])
+
+        return cls(StringTable.from_strings(nodes),
+                   StringTable.from_strings(relations),
+                   cls._csr(len(nodes), heads, relation_ids, tails),
+                   cls._csr(len(nodes), tails, relation_ids, heads))
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def n_edges(self) -> int:
+        return len(self.forward.neighbours)
+
+    def ids(self, nodes: Iterable[str]) -> np.ndarray:
+        """Node ids of strings, unknown strings get id -1"""
+        return self.nodes.ids(nodes)
+
+    def relation_mask(self, relations: Iterable[str] = None) -> np.ndarray:
+        """Boolean mask over relation ids, `None` allows all relations"""
+        if relations is None:
+            return np.ones(len(self.relations), dtype=bool)
+        mask = np.zeros(len(self.relations), dtype=bool)
+        ids = [self.relations.id(r) for r in relations]
+        mask[[i for i in ids if i >= 0]] = True
+        return mask
+
+    def expand(self,
+               seeds: Sequence[Union[Sequence[int], Sequence[str]]],
+               hops: int = 2,
+               relations: Iterable[str] = None,
+               fan_out: Union[int, Sequence[int]] = None,
+               direction: Union[str, Sequence[str]] = 'forward') -> Expansion:
+        """Batched k-hop breadth first search, every seed set is expanded
+        independently and every node is visited once per seed set
+
+        Args:
+            seeds - node ids or node strings per batch entry
+            hops - number of hops
+            relations - relations to follow, `None` follows all
+            fan_out - maximum number of edges followed per node, either for
+                all hops or per hop, `None` follows all edges
+            direction - forward (head to tail) or reverse (tail to head),
+                either for all hops or per hop
+
+        Returns:
+            traversed edges of all batch entries
+        """
+        if fan_out is None or isinstance(fan_out, int):
+            fan_out = [fan_out] * hops
+        if isinstance(direction, str):
+            direction = [direction] * hops
+        allowed = self.relation_mask(relations)
+        n = np.int64(len(self))
+
+        batch = np.repeat(np.arange(len(seeds)), [len(s) for s in seeds])
+        frontier = np.array([
+            self.nodes.id(i) if isinstance(i, str) else i for s in seeds
+            for i in s
+        ], dtype=np.int64)
+        known = frontier >= 0
+        batch, frontier = batch[known], frontier[known]
+        visited = np.unique(batch * n + frontier)
+
+        res = []
+        for hop in range(hops):
+            if len(frontier) == 0:
+                break
+            adjacency = getattr(self, direction[hop])
+            edges = gather_ranges(adjacency.offsets, frontier)
+            lengths = adjacency.offsets[frontier + 1] - adjacency.offsets[frontier]
+            rows = np.repeat(np.arange(len(frontier)), lengths)
+
+            keep = allowed[adjacency.relation_ids[edges]]
+            edges, rows = edges[keep], rows[keep]
+            if fan_out[hop] is not None:
+                # rank of every edge within its node, rows are grouped
+                counts = np.bincount(rows, minlength=len(frontier))
+                starts = np.cumsum(counts) - counts
+                rank = np.arange(len(rows)) - starts[rows]
+                edges, rows = edges[rank < fan_out[hop]], rows[rank < fan_out[hop]]
+
+            targets = adjacency.neighbours[edges].astype(np.int64)
+            res.append(
+                Expansion(batch[rows], frontier[rows],
+                          adjacency.relation_ids[edges], targets,
+                          np.full(len(edges), hop + 1, dtype=np.int8)))
+
+            # unseen targets become the next frontier, in order of discovery
+            keys = batch[rows] * n + targets
+            keys, first = np.unique(keys, return_index=True)
+            unseen = ~np.isin(keys, visited, assume_unique=True)
+            keys = keys[unseen][np.argsort(first[unseen])]
+            visited = np.union1d(visited, keys)
+            batch, frontier = keys // n, keys % n
+
+        if not res:
+            empty = np.zeros(0, dtype=np.int64)
+            return Expansion(empty, empty, empty, empty, empty)
+        return Expansion(*(np.concatenate(c) for c in zip(*res)))
+
+    def resolve(self, expansion: Expansion,
+                n_batch: int) -> List[List[tuple]]:
+        """Resolves expanded edges to (hop, source, relation, target) strings per batch entry"""
+        res = [[] for _ in range(n_batch)]
+        for b, s, r, t, h in zip(*expansion):
+            res[b].append(
+                (int(h), self.nodes[s], self.relations[r], self.nodes[t]))
+        return res
+
+    def save(self, path: str = f'{DATA_ROOT}/atomic/graph'):
+        os.makedirs(path, exist_ok=True)
+        self.nodes.save(path, 'nodes')
+        self.relations.save(path, 'relations')
+        for direction in ['forward', 'reverse']:
+            for name, array in getattr(self, direction)._asdict().items():
+                np.save(f'{path}/{direction}-{name}.npy', array)
+
+    @classmethod
+    def load(cls,
+             path: str = f'{DATA_ROOT}/atomic/graph',
+             mmap_mode: str = 'r') -> 'AtomicGraph':
+        forward, reverse = (Adjacency(*(
+            np.load(f'{path}/{direction}-{name}.npy', mmap_mode=mmap_mode)
+            for name in Adjacency._fields)) for direction in ['forward', 'reverse'])
+        return cls(StringTable.load(path, 'nodes', mmap_mode),
+                   StringTable.load(path, 'relations', mmap_mode), forward,
+                   reverse)
+
+
+def build_graph(save_to: str = f'{DATA_ROOT}/atomic/graph') -> AtomicGraph:
+    """Builds atomic graph from the cached atomic build
+
+    Args:
+        save_to - directory to save graph to, if `None` the graph is not saved
+
+    Returns:
+        atomic graph
+    """
+    graph = AtomicGraph.from_frame(load_atomic_data(categorical=True))
+    if save_to is not None:
+        graph.save(save_to)
+    return graph
+
+
+if __name__ == "__main__":
+    build_graph()
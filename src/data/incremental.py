@@ -0,0 +1,203 @@
+"""Incremental updates of the Atomic indexes when heads are added"""
+
+import hashlib
+import json
+import os
+import pickle
+from typing import Iterable
+
+from bert_score import BERTScorer
+import numpy as np
+import pandas as pd
+
+from src_old.constants import DATA_ROOT
+from src_old.data.atomic import LemmaIndex, load_atomic_data, lookup_entries, parse
+from src_old.data.embeddings import HeadEmbeddings, IVFIndex
+from src_old.data.parse_store import read_parse_stores
+from src_old.data.relation_store import RelationStore
+
+Dataframe = pd.DataFrame
+
+
+def head_hashes(heads: Iterable[str]) -> np.ndarray:
+    """64 bit content hashes of heads"""
+    return np.array([
+        int.from_bytes(
+            hashlib.blake2b(h.encode('utf8'), digest_size=8).digest(),
+            'little') for h in heads
+    ], dtype=np.uint64)
+
+
+class IndexVersion:
+    """Version of the Atomic indexes and the content hashes of all original
+    heads they were built from"""
+    def __init__(self, path: str, version: int, hashes: np.ndarray):
+        self.path = path
+        self.version = version
+        self.hashes = np.unique(hashes)
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        """Mask of hashes that are already indexed"""
+        return np.isin(hashes, self.hashes)
+
+    def bump(self, hashes: np.ndarray) -> 'IndexVersion':
+        return IndexVersion(self.path, self.version + 1,
+                            np.concatenate([self.hashes, hashes]))
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        np.save(f'{self.path}/head-hashes.npy', self.hashes)
+        # written last, a crashed update keeps the previous version
+        with open(f'{self.path}/version.json', 'w') as f:
+            json.dump({'version': self.version, 'n_heads': len(self.hashes)}, f)
+
+    @classmethod
+    def load(cls,
+             path: str = f'{DATA_ROOT}/atomic/version',
+             parses: str = f'{DATA_ROOT}/atomic/parse-dp') -> 'IndexVersion':
+        """Loads version, an index built before versioning becomes version 0
+        with the hashes of all heads in its parse stores
+
+        Args:
+            path - version directory
+            parses - parse stores the indexes were built from
+
+        Returns:
+            index version
+        """
+        if os.path.exists(f'{path}/version.json'):
+            with open(f'{path}/version.json', 'r') as f:
+                version = json.load(f)['version']
+            return cls(path, version, np.load(f'{path}/head-hashes.npy'))
+
+        hashes = [np.zeros(0, dtype=np.uint64)]
+        if os.path.exists(parses):
+            hashes.extend(
+                head_hashes(store.origins)
+                for store in read_parse_stores(parses))
+        return cls(path, 0, np.concatenate(hashes))
+
+
+def update_knowledge_base(
+        atomic: Dataframe,
+        root: str = f'{DATA_ROOT}/atomic',
+        n_process: int = 4,
+        batch_size: int = 256,
+        model_type: str = 'distilbert-base-uncased',
+        source: Dataframe = None) -> IndexVersion:
+    """Parses, indexes and embeds only heads that are not indexed yet and
+    appends them and their relations to the existing structures. Existing head ids stay valid,
+    the version is bumped once all structures are updated. A crashed update
+    resumes when run again.
+
+    Args:
+        atomic - atomic dataframe with filled placeholders and `origin` column
+        root - directory holding the atomic indexes
+        n_process - number of spacy worker processes
+        batch_size - number of heads per spacy batch
+        model_type - model used by the retrieval scorer
+        source - unfilled atomic dataframe the relations of new heads are
+            taken from, defaults to `load_atomic_data`
+
+    Returns:
+        index version after the update
+    """
+    version = IndexVersion.load(f'{root}/version', f'{root}/parse-dp')
+    if not os.path.exists(f'{root}/version/version.json'):
+        # the baseline is saved before any increment is parsed
+        version.save()
+    origins = atomic['origin'].dropna().unique()
+    hashes = head_hashes(origins)
+    new = ~version.contains(hashes)
+    if not new.any():
+        print(f'No new heads, staying at version {version.version}')
+        return version
+    print(f'Found {new.sum()} new heads')
+
+    increment = f'{root}/parse-dp/increments/{version.version + 1:04d}'
+    parse(atomic[atomic['origin'].isin(origins[new])],
+          'head',
+          'dp',
+          save_to=increment,
+          n_process=n_process,
+          batch_size=batch_size)
+    entries = lookup_entries(read_parse_stores(increment))
+
+    if os.path.exists(f'{root}/lookup.pickle'):
+        with open(f'{root}/lookup.pickle', 'rb') as p:
+            lookup = pickle.load(p)
+        lookup.update(entries)
+        with open(f'{root}/lookup.pickle', 'wb') as p:
+            pickle.dump(lookup, p)
+
+    # indexes are loaded into memory, their files are overwritten
+    index = LemmaIndex.load(f'{root}/lemma_index', mmap_mode=None)
+    index = index.extend(entries)
+    index.save(f'{root}/lemma_index')
+
+    # heads indexed by a crashed update are embedded as well
+    if os.path.exists(f'{root}/head_embeddings'):
+        embeddings = HeadEmbeddings.load(f'{root}/head_embeddings',
+                                         mmap_mode=None)
+        ids = np.arange(len(embeddings), len(index))
+        if len(ids):
+            scorer = BERTScorer(model_type=model_type, lang='en')
+            added = HeadEmbeddings.from_texts(index.texts.resolve(ids), scorer)
+            embeddings.extend(added).save(f'{root}/head_embeddings')
+
+        if os.path.exists(f'{root}/ivf_index'):
+            ivf = IVFIndex.load(f'{root}/ivf_index', mmap_mode=None)
+            embeddings = HeadEmbeddings.load(f'{root}/head_embeddings')
+            ids = np.arange(len(ivf), len(embeddings))
+            if len(ids):
+                # new heads are at the end, only those are pooled
+                start = embeddings.offsets[ids[0]]
+                added = HeadEmbeddings(embeddings.embeddings[start:],
+                                       embeddings.weights[start:],
+                                       embeddings.offsets[ids[0]:] - start)
+                ivf.add(added.pooled(), ids).save(f'{root}/ivf_index')
+
+    if os.path.exists(f'{root}/relation_store'):
+        # store and processed.tsv are keyed by the original, unfilled heads
+        if source is None:
+            source = load_atomic_data()
+        rows = source[source['head'].isin(origins[new])].astype(
+            {'head': object}).assign(origin=lambda d: d['head'])
+        store = RelationStore.load(f'{root}/relation_store', mmap_mode=None)
+        # rows of heads a crashed update already stored are skipped
+        rows = rows[store.heads.ids(rows['origin']) < 0]
+
+        tail_col = 'tail'
+        processed = f'{root}/processed.tsv'
+        if os.path.exists(processed):
+            columns = pd.read_csv(processed, sep='\t', nrows=0).columns[1:]
+            if 'relation-text' in columns and 'relation-text' not in rows:
+                rows = rows.rename(columns={'tail': 'relation-text'})
+            # appended before the store is saved, a crashed update may
+            # repeat rows in the tsv but never loses them
+            rows.reindex(columns=columns).to_csv(processed,
+                                                 sep='\t',
+                                                 encoding='utf8',
+                                                 mode='a',
+                                                 header=False)
+        if 'relation-text' in rows.columns:
+            tail_col = 'relation-text'
+        store.extend(rows, head_col='origin', tail_col=tail_col).save(
+            f'{root}/relation_store')
+
+        # round trip, every new origin with informative tails has relations
+        store = RelationStore.load(f'{root}/relation_store')
+        tails = rows[tail_col].astype(object)
+        informative = rows.loc[tails.notna() & ~tails.str.strip().isin(
+            ['none', '']), 'origin'].unique().tolist()
+        missing = [
+            h for e in store.lookup(informative) for h, r in e.items() if not r
+        ]
+        if missing:
+            raise RuntimeError(
+                f'{len(missing)} new heads have no relations, e.g. {missing[0]}')
+
+    version = version.bump(hashes[new])
+    version.save()
+    print(f'Updated knowledge base to version {version.version}')
+    return version
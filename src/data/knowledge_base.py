@@ -0,0 +1,99 @@
+"""Lazily loaded Atomic knowledge base used for retrieval"""
+
+import os
+from time import perf_counter
+from typing import Any, Callable
+
+from bert_score import BERTScorer
+import psutil
+
+from src_old.constants import DATA_ROOT
+from src_old.data.atomic import LemmaIndex
+from src_old.data.embeddings import HeadEmbeddings, IVFIndex
+from src_old.data.graph import AtomicGraph
+from src_old.data.relation_store import RelationStore
+
+
+class KnowledgeBase:
+    """Holds all structures the retrieval stack reads from. Every part is loaded
+    on first access, indexes are memory mapped read-only, so forked workers
+    share their pages instead of copying them. Load time and resident memory
+    are reported for every part."""
+    def __init__(self,
+                 root: str = f'{DATA_ROOT}/atomic',
+                 model_type: str = 'distilbert-base-uncased',
+                 mmap_mode: str = 'r',
+                 verbose: bool = True):
+        """Creates knowledge base without loading anything
+
+        Args:
+            root - directory holding the built indexes
+            model_type - model used by the retrieval scorer
+            mmap_mode - numpy memory map mode, `None` loads into memory
+            verbose - if true reports load time and resident memory
+        """
+        self.root = root
+        self.model_type = model_type
+        self.mmap_mode = mmap_mode
+        self.verbose = verbose
+        self._parts = {}
+
+    def _get(self, name: str, load: Callable[[], Any]) -> Any:
+        """Loads part once and reports time and resident memory"""
+        if name not in self._parts:
+            process = psutil.Process(os.getpid())
+            rss = process.memory_info().rss
+            start = perf_counter()
+            self._parts[name] = load()
+            if self.verbose:
+                now = process.memory_info().rss
+                print(f'Loaded {name} in {perf_counter() - start:.2f}s, '
+                      f'resident memory {now / 2**20:.0f} MB '
+                      f'(+{(now - rss) / 2**20:.0f} MB)')
+        return self._parts[name]
+
+    @property
+    def lemma_index(self) -> LemmaIndex:
+        return self._get(
+            'lemma_index',
+            lambda: LemmaIndex.load(f'{self.root}/lemma_index', self.mmap_mode))
+
+    @property
+    def relation_store(self) -> RelationStore:
+        return self._get(
+            'relation_store', lambda: RelationStore.load(
+                f'{self.root}/relation_store', self.mmap_mode))
+
+    @property
+    def head_embeddings(self) -> HeadEmbeddings:
+        return self._get(
+            'head_embeddings', lambda: HeadEmbeddings.load(
+                f'{self.root}/head_embeddings', self.mmap_mode))
+
+    @property
+    def ivf_index(self) -> IVFIndex:
+        return self._get(
+            'ivf_index',
+            lambda: IVFIndex.load(f'{self.root}/ivf_index', self.mmap_mode))
+
+    @property
+    def graph(self) -> AtomicGraph:
+        return self._get(
+            'graph', lambda: AtomicGraph.load(f'{self.root}/graph', self.mmap_mode))
+
+    @property
+    def scorer(self) -> BERTScorer:
+        return self._get(
+            'scorer', lambda: BERTScorer(model_type=self.model_type,
+                                         lang='en',
+                                         rescale_with_baseline=True))
+
+    def load(self) -> 'KnowledgeBase':
+        """Loads all parts explicitly, e.g. before forking workers"""
+        for part in ['lemma_index', 'relation_store', 'head_embeddings',
+                     'ivf_index', 'scorer']:
+            getattr(self, part)
+        return self
+
+    def __repr__(self) -> str:
+        return f'KnowledgeBase(root={self.root}, loaded={list(self._parts)})'
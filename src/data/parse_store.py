@@ -0,0 +1,402 @@
+"""Columnar storage of dependency parses"""
+
+from collections import Counter, defaultdict
+from glob import glob
+import json
+from multiprocessing import cpu_count
+import os
+import pickle
+import shutil
+from typing import Iterable, Iterator, List, Mapping, NamedTuple, Sequence, Tuple
+import zlib
+
+from multiprocess.pool import Pool
+import numpy as np
+import pandas as pd
+from spacy.tokens.doc import Doc
+from tqdm import tqdm
+
+from src_old.data.relation_store import StringTable
+from src_old.data.shards import ShardManifest
+
+# token attributes stored as interned ids
+COLUMNS = ('word', 'lemma', 'pos', 'tag', 'dep')
+
+
+class Ragged(NamedTuple):
+    """Variable length rows, row `i` holds `values[offsets[i]:offsets[i + 1]]`"""
+    offsets: np.ndarray
+    values: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def split(self) -> List[np.ndarray]:
+        """Splits values into one array per row"""
+        if len(self) == 0:
+            return []
+        return np.split(self.values, self.offsets[1:-1])
+
+
+# extracted relation columns: token mask attribute, mask values, collected attribute
+RELATION_COLUMNS = {
+    'objects': ('dep', ['dobj', 'pobj'], 'word'),
+    'verbs': ('pos', ['VERB'], 'lemma')
+}
+
+
+class ParseStore:
+    """Dependency parses of many sentences as flat per-token arrays, the tokens
+    of sentence `i` are the rows `offsets[i]:offsets[i + 1]`. Token attributes
+    are ids into interned vocabularies, `heads` holds the index of every
+    token's syntactic head within its sentence. All parts are numpy arrays,
+    which can be memory mapped read-only."""
+    def __init__(self, texts: StringTable, origins: StringTable,
+                 vocab: Mapping[str, StringTable], columns: Mapping[str,
+                                                                 np.ndarray],
+                 heads: np.ndarray, offsets: np.ndarray):
+        self.texts = texts
+        self.origins = origins
+        self.vocab = vocab
+        self.columns = columns
+        self.heads = heads
+        self.offsets = offsets
+        self._labels = {}
+
+    @classmethod
+    def from_docs(cls,
+                  docs: Iterable[Doc],
+                  origins: Iterable[str] = None) -> 'ParseStore':
+        """Flattens parsed docs into token arrays
+
+        Args:
+            docs - parsed spacy docs, one per sentence
+            origins - original text of every doc, defaults to the doc text
+
+        Returns:
+            parse store
+        """
+        interned = {c: {} for c in COLUMNS}
+        ids = {c: [] for c in COLUMNS}
+        heads = []
+        lengths = []
+        texts = []
+        for doc in docs:
+            texts.append(doc.text)
+            lengths.append(len(doc))
+            for t in doc:
+                for c, value in zip(COLUMNS,
+                                    (t.text, t.lemma_, t.pos_, t.tag_, t.dep_)):
+                    ids[c].append(interned[c].setdefault(value,
+                                                         len(interned[c])))
+                heads.append(t.head.i)
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        texts = StringTable.from_strings(texts)
+        return cls(
+            texts,
+            texts if origins is None else StringTable.from_strings(origins),
+            {c: StringTable.from_strings(interned[c]) for c in COLUMNS},
+            {c: np.asarray(ids[c], dtype=np.int32) for c in COLUMNS},
+            np.asarray(heads, dtype=np.int32), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def sentence_ids(self) -> np.ndarray:
+        """Sentence id of every token"""
+        return np.repeat(np.arange(len(self)), self.lengths())
+
+    def labels(self, column: str) -> np.ndarray:
+        """Vocabulary of a token attribute as object array, indexable by ids"""
+        if column not in self._labels:
+            self._labels[column] = np.array(list(self.vocab[column]),
+                                            dtype=object)
+        return self._labels[column]
+
+    def mask(self, column: str, values: Iterable[str]) -> np.ndarray:
+        """Boolean mask of tokens whose attribute is one of values
+
+        Args:
+            column - token attribute: word, lemma, pos, tag, dep
+            values - attribute values to match
+
+        Returns:
+            mask over all tokens
+        """
+        ids = [self.vocab[column].id(v) for v in values]
+        return np.isin(self.columns[column], [i for i in ids if i >= 0])
+
+    def ragged(self, mask: np.ndarray, column: str) -> 'Ragged':
+        """Collects attribute ids of masked tokens per sentence in one pass
+
+        Args:
+            mask - mask over all tokens
+            column - token attribute to collect
+
+        Returns:
+            ragged ids, the values of sentence `i` are `values[offsets[i]:offsets[i + 1]]`
+        """
+        positions = np.flatnonzero(mask)
+        offsets = np.searchsorted(positions, self.offsets).astype(np.int64)
+        return Ragged(offsets, self.columns[column][positions])
+
+    def gather(self, mask: np.ndarray, column: str) -> List[List[str]]:
+        """Collects attribute values of masked tokens per sentence
+
+        Args:
+            mask - mask over all tokens
+            column - token attribute to collect
+
+        Returns:
+            list of attribute values per sentence
+        """
+        ragged = self.ragged(mask, column)
+        values = self.labels(column)[ragged.values].tolist()
+        bounds = ragged.offsets.tolist()
+        return [values[s:e] for s, e in zip(bounds[:-1], bounds[1:])]
+
+    def structures(self) -> List[str]:
+        """Dependency parse structure of every sentence, dependency labels joined by `-`"""
+        deps = self.labels('dep')[self.columns['dep']].tolist()
+        bounds = self.offsets.tolist()
+        return ['-'.join(deps[s:e]) for s, e in zip(bounds[:-1], bounds[1:])]
+
+    def sentence(self, i: int, columns: Sequence[str] = COLUMNS) -> dict:
+        """Resolves the tokens of a single sentence
+
+        Args:
+            i - sentence id
+            columns - token attributes to resolve
+
+        Returns:
+            dict of attribute name to list of values, with `head` indices
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        res = {
+            c: self.labels(c)[self.columns[c][start:end]].tolist()
+            for c in columns
+        }
+        res['head'] = self.heads[start:end].tolist()
+        return res
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        # relation columns of a previous store index into its vocabulary
+        for name in RELATION_COLUMNS:
+            for part in ['offsets', 'values']:
+                if os.path.exists(f'{path}/{name}-{part}.npy'):
+                    os.remove(f'{path}/{name}-{part}.npy')
+        self.texts.save(path, 'texts')
+        self.origins.save(path, 'origins')
+        for c in COLUMNS:
+            self.vocab[c].save(path, c)
+            np.save(f'{path}/{c}-ids.npy', self.columns[c])
+        np.save(f'{path}/heads.npy', self.heads)
+        np.save(f'{path}/offsets.npy', self.offsets)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: str = 'r') -> 'ParseStore':
+        return cls(
+            StringTable.load(path, 'texts', mmap_mode),
+            StringTable.load(path, 'origins', mmap_mode),
+            {c: StringTable.load(path, c, mmap_mode) for c in COLUMNS}, {
+                c: np.load(f'{path}/{c}-ids.npy', mmap_mode=mmap_mode)
+                for c in COLUMNS
+            }, np.load(f'{path}/heads.npy', mmap_mode=mmap_mode),
+            np.load(f'{path}/offsets.npy', mmap_mode=mmap_mode))
+
+
+def parse_store_paths(path: str) -> List[str]:
+    """Directories of all parse stores in a single store or a shard directory,
+    followed by the stores of its increments"""
+    paths = [path]
+    if os.path.exists(f'{path}/manifest.json'):
+        paths = list(ShardManifest.open(path).shards(suffix=''))
+    # increments appended by `update_knowledge_base`
+    for increment in sorted(glob(f'{path}/increments/*')):
+        paths.extend(parse_store_paths(increment))
+    return paths
+
+
+def read_parse_stores(path: str, mmap_mode: str = 'r') -> Iterator[ParseStore]:
+    """Streams parse stores from a single store or a shard directory
+
+    Args:
+        path - store directory or shard directory with manifest
+        mmap_mode - numpy memory map mode, `None` loads into memory
+
+    Returns:
+        iterator over parse stores
+    """
+    for p in parse_store_paths(path):
+        yield ParseStore.load(p, mmap_mode)
+
+
+def _bucket(structure: str, n_buckets: int) -> int:
+    """Stable bucket of a structure, equal across processes"""
+    return zlib.crc32(structure.encode('utf8')) % n_buckets
+
+
+def _count_shard(job: Tuple[int, str, str, int]) -> Counter:
+    """Counts structures of one parse store and spills its members to bucket files"""
+    shard, path, spill_to, n_buckets = job
+    store = ParseStore.load(path)
+    counter = Counter()
+    buckets = defaultdict(lambda: defaultdict(list))
+    for text, structure in zip(store.texts, store.structures()):
+        counter[structure] += 1
+        buckets[_bucket(structure, n_buckets)][structure].append(text)
+
+    for b, members in buckets.items():
+        with open(f'{spill_to}/{b:04d}-{shard:05d}.pickle', 'wb') as p:
+            pickle.dump(dict(members), p)
+    return counter
+
+
+class StructureCounts:
+    """Counts of dependency parse structures with their members spilled to
+    disk, members of a structure are stored in one of `n_buckets` bucket
+    files per shard, so only a single bucket file is held in memory"""
+    def __init__(self, path: str, counter: Counter, n_buckets: int):
+        self.path = path
+        self.counter = counter
+        self.n_buckets = n_buckets
+
+    def __len__(self) -> int:
+        return len(self.counter)
+
+    def __getitem__(self, structure: str) -> int:
+        return self.counter[structure]
+
+    def top(self, k: int = 10) -> List[Tuple[str, int]]:
+        """Returns the k most common structures with their counts"""
+        return self.counter.most_common(k)
+
+    def members(self, structure: str) -> Iterator[str]:
+        """Streams the parsed texts of a structure in shard order"""
+        b = _bucket(structure, self.n_buckets)
+        for f in sorted(glob(f'{self.path}/{b:04d}-*.pickle')):
+            with open(f, 'rb') as p:
+                yield from pickle.load(p).get(structure, [])
+
+    def save(self):
+        with open(f'{self.path}/counts.json', 'w') as f:
+            json.dump({'n_buckets': self.n_buckets, 'counts': self.counter}, f)
+
+    @classmethod
+    def load(cls, path: str) -> 'StructureCounts':
+        with open(f'{path}/counts.json', 'r') as f:
+            data = json.load(f)
+        return cls(path, Counter(data['counts']), data['n_buckets'])
+
+
+# marks spill directories written by `count_structures`
+STRUCTURES_MARKER = '.structure-counts'
+
+
+def count_structures(path: str,
+                     spill_to: str = None,
+                     n_workers: int = cpu_count(),
+                     n_buckets: int = 64) -> StructureCounts:
+    """Counts dependency parse structures over all shards in a process pool,
+    partial counters are merged and members are spilled to disk
+
+    Args:
+        path - parse store or shard directory of parse stores
+        spill_to - directory for member buckets, defaults to `{path}/structures`,
+            must be empty or written by a previous count
+        n_workers - number of worker processes
+        n_buckets - number of bucket files per shard
+
+    Returns:
+        structure counts
+    """
+    if spill_to is None:
+        spill_to = f'{path}/structures'
+    # only directories created here are cleared, they hold a marker file
+    if os.path.exists(f'{spill_to}/{STRUCTURES_MARKER}'):
+        shutil.rmtree(spill_to)
+    elif os.path.isdir(spill_to) and os.listdir(spill_to):
+        raise FileExistsError(
+            f'{spill_to} is not empty and was not created by count_structures')
+    os.makedirs(spill_to, exist_ok=True)
+    open(f'{spill_to}/{STRUCTURES_MARKER}', 'w').close()
+
+    jobs = [(i, p, spill_to, n_buckets)
+            for i, p in enumerate(parse_store_paths(path))]
+    counter = Counter()
+    with Pool(max(1, min(n_workers, len(jobs)))) as pool:
+        for shard_counts in tqdm(pool.imap_unordered(_count_shard, jobs),
+                                 total=len(jobs)):
+            counter.update(shard_counts)
+
+    counts = StructureCounts(spill_to, counter, n_buckets)
+    counts.save()
+    return counts
+
+
+def extract_relations(path: str) -> str:
+    """Extracts objects and verb lemmas of every sentence of a parse store with
+    token masks and saves them as ragged id columns next to the store
+
+    Args:
+        path - parse store directory
+
+    Returns:
+        path
+    """
+    store = ParseStore.load(path)
+    for name, (column, values, collect) in RELATION_COLUMNS.items():
+        ragged = store.ragged(store.mask(column, values), collect)
+        np.save(f'{path}/{name}-offsets.npy', ragged.offsets)
+        np.save(f'{path}/{name}-values.npy', ragged.values)
+    return path
+
+
+def load_relations(path: str, name: str, mmap_mode: str = 'r') -> Ragged:
+    """Loads a relation column saved by `extract_relations`"""
+    return Ragged(np.load(f'{path}/{name}-offsets.npy', mmap_mode=mmap_mode),
+                  np.load(f'{path}/{name}-values.npy', mmap_mode=mmap_mode))
+
+
+def relation_frame(path: str, n_workers: int = cpu_count()) -> pd.DataFrame:
+    """Extracts relation columns of all shards in parallel, shards with saved
+    columns are not extracted again
+
+    Args:
+        path - parse store or shard directory of parse stores
+        n_workers - number of worker processes
+
+    Returns:
+        dataframe indexed by parsed text with a list column per relation column
+    """
+    paths = parse_store_paths(path)
+    pending = [
+        p for p in paths
+        if not all(os.path.exists(f'{p}/{name}-values.npy')
+                   for name in RELATION_COLUMNS)
+    ]
+    if pending:
+        with Pool(max(1, min(n_workers, len(pending)))) as pool:
+            list(tqdm(pool.imap_unordered(extract_relations, pending),
+                      total=len(pending)))
+
+    frames = []
+    for p in paths:
+        store = ParseStore.load(p)
+        columns = {}
+        for name, (_, _, collect) in RELATION_COLUMNS.items():
+            # ids are resolved with the vocabulary of their shard
+            ragged = load_relations(p, name)
+            ragged = Ragged(ragged.offsets, store.labels(collect)[ragged.values])
+            columns[name] = [v.tolist() for v in ragged.split()]
+        frames.append(
+            pd.DataFrame(columns, index=pd.Index(list(store.texts), dtype=object)))
+
+    df = pd.concat(frames)
+    return df[~df.index.duplicated()]
@@ -0,0 +1,107 @@
+"""Offline knowledge retrieval over dialog datasets"""
+
+from typing import List, Mapping
+
+from datasets import load_dataset
+from datasets.dataset_dict import DatasetDict
+# hy needed for modules written in hy-lang [knowledge_extraction]
+import hy
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+from src_old.constants import DATA_ROOT
+from src_old.data.relation_store import KNOWLEDGE_GROUPS
+from src_old.knowledge_extraction import extract_from_atomic, kb, retrieve_overlap_batch
+from src_old.models.dialog_guiding_module.dialog_guiding_module import prepare_relations
+from src_old.utils import freeze_weights
+
+
+def retrieve_knowledge(batch: Mapping[str, List[str]],
+                       column: str = 'current') -> Mapping[str, List[str]]:
+    """Retrieves and prepares knowledge for a batch of utterances
+
+    Args:
+        batch - batch of dataset entries
+        column - column holding the utterances
+
+    Returns:
+        event, mental and moral knowledge strings per utterance
+    """
+    overlaps = retrieve_overlap_batch(batch[column])
+    knowledge = [
+        prepare_relations(
+            None if o is None else extract_from_atomic(
+                o, KNOWLEDGE_GROUPS, False, True), kb.relation_store.tails)
+        for o in overlaps
+    ]
+    event, mental, moral = zip(*knowledge) if knowledge else ([], [], [])
+    return {'event': list(event), 'mental': list(mental), 'moral': list(moral)}
+
+
+def classify_turn_types(data: DatasetDict,
+                        hf_checkpoint: str,
+                        column: str = 'current',
+                        batch_size: int = 64) -> DatasetDict:
+    """Adds the next turn type predicted by the turn classifier
+
+    Args:
+        data - dataset to classify
+        hf_checkpoint - huggingface checkpoint of the turn classifier
+        column - column holding the utterances
+        batch_size - batch size for the classifier
+
+    Returns:
+        dataset with added `turn_type` column
+    """
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    tokenizer = AutoTokenizer.from_pretrained(hf_checkpoint)
+    model = AutoModelForSequenceClassification.from_pretrained(hf_checkpoint).to(device)
+    freeze_weights(model)
+
+    def classify(batch: Mapping[str, List[str]]) -> Mapping[str, List[int]]:
+        tokenized = tokenizer(batch[column],
+                              truncation=True,
+                              padding='max_length',
+                              return_tensors='pt').to(device)
+        with torch.no_grad():
+            logits = model(**tokenized).logits
+        return {'turn_type': torch.argmax(logits, dim=-1).tolist()}
+
+    return data.map(classify, batched=True, batch_size=batch_size)
+
+
+def precompute_knowledge(
+    dataset: str = 'benjaminbeilharz/ed-for-lm',
+    save_to: str = f'{DATA_ROOT}/ed-for-lm-knowledge',
+    num_proc: int = 8,
+    batch_size: int = 64,
+    turn_classifier: str = None
+) -> DatasetDict:
+    """Materializes retrieval results of every split as dataset columns,
+    so training does not wait on retrieval
+
+    Args:
+        dataset - huggingface dataset with a `current` column
+        save_to - path to save the arrow dataset to
+        num_proc - number of worker processes running retrieval
+        batch_size - number of utterances retrieved at once
+        turn_classifier - if given, adds turn types predicted by this checkpoint
+
+    Returns:
+        dataset with added `event`, `mental`, `moral` (and `turn_type`) columns
+    """
+    data = load_dataset(dataset)
+    data = data.map(retrieve_knowledge,
+                    batched=True,
+                    batch_size=batch_size,
+                    num_proc=num_proc)
+    if turn_classifier is not None:
+        data = classify_turn_types(data, turn_classifier)
+    data.save_to_disk(save_to)
+    return data
+
+
+if __name__ == "__main__":
+    precompute_knowledge(
+        turn_classifier=
+        'benjaminbeilharz/bert-base-uncased-next-turn-classifier')
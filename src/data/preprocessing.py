@@ -3,10 +3,13 @@ Dataset preprocessing tool
 Run from root.
 """
 
+import ast
+from concurrent.futures import ThreadPoolExecutor
+import json
 import re
 from functools import partial
 from glob import glob
-from typing import Tuple, List, Mapping
+from typing import Any, Callable, Tuple, List, Mapping
 
 import pandas as pd
 
@@ -15,90 +18,122 @@ from src_old.data.reader import read_jsonlines
 glob = partial(glob, recursive=True)
 
 
-def rainbow_data(glob_path: str = './data/rainbow/**/train*') -> pd.DataFrame:
+def parse_json(x: Any) -> Any:
+    """Parses a nested json field, python reprs are read with `literal_eval`"""
+    if not isinstance(x, str):
+        return x
+    try:
+        return json.loads(x)
+    except json.JSONDecodeError:
+        return ast.literal_eval(x)
+
+
+def load_files(files: List[str],
+               read: Callable[[str], pd.DataFrame],
+               n_workers: int = 8,
+               ignore_index: bool = True) -> pd.DataFrame:
+    """Reads files concurrently and concatenates them once
+
+    Args:
+        files - files to read
+        read - reads a single file into a dataframe
+        n_workers - number of reader threads
+        ignore_index - if true the index of the files is replaced by a range
+
+    Returns:
+        dataframe holding the rows of all files in order of `files`
+    """
+    if not files:
+        return pd.DataFrame()
+    with ThreadPoolExecutor(max_workers=min(n_workers, len(files))) as pool:
+        frames = list(pool.map(read, files))
+    # categoricals with differing categories are concatenated as objects
+    categorical = [
+        c for c in frames[0].columns
+        if isinstance(frames[0][c].dtype, pd.CategoricalDtype)
+    ]
+    return pd.concat(frames, ignore_index=ignore_index).astype(
+        {c: 'category' for c in categorical})
+
+
+def rainbow_data(glob_path: str = './data/rainbow/**/train*',
+                 n_workers: int = 8) -> pd.DataFrame:
     datasets = glob(glob_path, recursive=True)
     corpus_tag_pattern = re.compile('\[\w+\]:')
     tag_open_pattern = re.compile('<\w+>')
     tag_closed_pattern = re.compile('</\w+>')
-    
-    def process_dataset(filepath: str) -> pd.DataFrame:
-        d = pd.read_csv(filepath, encoding='utf8', index_col='index')
-
-        def process_string(s: str) -> str:
-            s = re.sub(corpus_tag_pattern, '', s)
-            s = re.sub(tag_open_pattern, '', s)
-            s = re.sub(tag_closed_pattern, '', s)
-            s = re.sub('\n', '', s) 
-            return s
 
-        d['inputs'] = d['inputs'].apply(lambda x: process_string(x))
+    def process_dataset(filepath: str) -> pd.DataFrame:
+        d = pd.read_csv(filepath,
+                        encoding='utf8',
+                        index_col='index',
+                        usecols=['index', 'inputs', 'targets'])
+
+        s = d['inputs']
+        for pattern in [corpus_tag_pattern, tag_open_pattern, tag_closed_pattern, '\n']:
+            s = s.str.replace(pattern, '', regex=True)
+        d['inputs'] = s
         return d[['inputs', 'targets']]
 
-    df = process_dataset(datasets[0])
-    for dataset in datasets[1:]:
-        df.append(process_dataset(dataset))
-
-    return df
+    return load_files(datasets, process_dataset, n_workers, ignore_index=False)
 
 
-def social_chem(glob_path: str = './data/processed/social_chem*') -> pd.DataFrame:
+def social_chem(glob_path: str = './data/processed/social_chem*',
+                n_workers: int = 8) -> pd.DataFrame:
     datasets = glob(glob_path)
     cols = ['split', 'rot-categorization', 'rot-judgment', 'action', 'action-agree', 'situation', 'rot']
-    
-    df = pd.read_csv(datasets[0], sep='\t', encoding='utf8')[cols]
-    for dataset in datasets[1:]:
-        df.append(pd.read_csv(dataset, sep='\t', encoding='utf8')[cols])
-        
-    return df
 
+    def read(dataset: str) -> pd.DataFrame:
+        return pd.read_csv(dataset,
+                           sep='\t',
+                           encoding='utf8',
+                           usecols=cols,
+                           dtype={'split': 'category'})[cols]
 
-def scruples(glob_path: str = './data/processed/*scruples*') -> Tuple[pd.DataFrame, pd.DataFrame]:
+    return load_files(datasets, read, n_workers)
+
+
+def scruples(glob_path: str = './data/processed/*scruples*',
+             n_workers: int = 8) -> Tuple[pd.DataFrame, pd.DataFrame]:
     datasets = glob(glob_path)
-    
+
     def anecdotes(dataset: str) -> pd.DataFrame:
         cols = ['text', 'action', 'label', 'binarized_label']
-        d = pd.read_csv(dataset, sep='\t', encoding='utf8')[cols]
-        return d
-        
+        return pd.read_csv(dataset,
+                           sep='\t',
+                           encoding='utf8',
+                           usecols=cols,
+                           dtype={'label': 'category'})[cols]
+
     def dilemmas(dataset: str) -> pd.DataFrame:
         cols = ['actions', 'gold_label', 'controversial']
-        d = pd.read_csv(dataset, sep='\t', encoding='utf8')[cols]
+        d = pd.read_csv(dataset, sep='\t', encoding='utf8', usecols=cols)[cols]
 
-        def proc(e: List[Mapping[str, str]]) -> List[str]:
-            return [i['description'] for i in eval(e)]
+        def proc(e: str) -> List[str]:
+            return [i['description'] for i in parse_json(e)]
 
-        d['actions'] = d['actions'].apply(lambda x: proc(x))
+        d['actions'] = d['actions'].map(proc)
         return d
-    
-    df_anecdotes = [anecdotes(d) for d in datasets if 'anecdotes' in d]
-    df_dilemmas = [dilemmas(d) for d in datasets if 'dilemmas' in d]
-    df_anecdote = df_anecdotes[0]
-    df_dilemma = df_dilemmas[0]
-
-    for d in df_anecdotes[1:]:
-        df_anecdote.append(d)
 
-    for d in df_dilemmas[1:]:
-        df_dilemma.append(d)
+    df_anecdote = load_files([d for d in datasets if 'anecdotes' in d],
+                             anecdotes, n_workers)
+    df_dilemma = load_files([d for d in datasets if 'dilemmas' in d], dilemmas,
+                            n_workers)
 
     return (df_anecdote, df_dilemma)
 
-def moral_stories(glob_path: str = './data/moral_stories_datasets/**/*.jsonl') -> Tuple[pd.DataFrame, pd.DataFrame]:
+
+def moral_stories(glob_path: str = './data/moral_stories_datasets/**/*.jsonl',
+                  n_workers: int = 8) -> Tuple[pd.DataFrame, pd.DataFrame]:
     datasets = glob(glob_path)
-    d = read_jsonlines(datasets[0])
-    full_df = pd.DataFrame(d)
-    task, categories = datasets[1].split('/')[3:5]
-    mapped_df = pd.DataFrame(read_jsonlines(datasets[1]), index=None)
-    mapped_df.insert(0, 'Task', task)
-    mapped_df.insert(1, 'Category', categories)
-
-    for dataset in datasets[2:]:
+    full_df = pd.DataFrame(read_jsonlines(datasets[0]))
+
+    def mapped(dataset: str) -> pd.DataFrame:
         task, categories = dataset.split('/')[3:5]
-        tmp = pd.DataFrame(read_jsonlines(dataset), index=None)
-        tmp['Task'] = task
-        tmp['Category'] = categories
-        mapped_df.append(tmp)
+        d = pd.DataFrame(read_jsonlines(dataset), index=None)
+        d.insert(0, 'Task', task)
+        d.insert(1, 'Category', categories)
+        return d
 
+    mapped_df = load_files(datasets[1:], mapped, n_workers)
     return (full_df, mapped_df)
-
-
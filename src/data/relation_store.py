@@ -0,0 +1,438 @@
+"""Compact head-grouped relation store for Atomic, partitioned by relation group"""
+
+from collections import defaultdict
+from functools import lru_cache
+import hashlib
+import os
+from typing import Iterable, List, Mapping, NamedTuple, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src_old.constants import DATA_ROOT
+from src_old.utils import read_tsv
+
+Dataframe = pd.DataFrame
+Knowledge = Mapping[str, Mapping[str, List[str]]]
+
+
+def gather_ranges(offsets: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Concatenates the ranges `offsets[i]:offsets[i + 1]` of all ids
+
+    Args:
+        offsets - range offsets, one more than there are ids
+        ids - ids to gather ranges for
+
+    Returns:
+        positions, grouped by id in the given order
+    """
+    starts = offsets[ids]
+    lengths = offsets[ids + 1] - starts
+    shift = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return np.arange(lengths.sum(), dtype=np.int64) + shift
+
+
+def string_hash(s: bytes) -> int:
+    """64 bit content hash of an utf8 encoded string"""
+    return int.from_bytes(hashlib.blake2b(s, digest_size=8).digest(), 'little')
+
+
+class StringTable:
+    """Interned strings stored as one utf8 buffer with offsets, ids are positions.
+    Strings are looked up through their hashes sorted at build time, so a
+    memory mapped table is searched without decoding it into a dict."""
+    def __init__(self,
+                 data: np.ndarray,
+                 offsets: np.ndarray,
+                 hashes: np.ndarray = None,
+                 order: np.ndarray = None):
+        self.data = data
+        self.offsets = offsets
+        # sorted string hashes and the ids in that order
+        self.hashes = hashes
+        self.order = order
+
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]) -> 'StringTable':
+        encoded = [s.encode('utf8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(data, offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.offsets.nbytes
+
+    def _bytes(self, i: int) -> bytes:
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            return None
+        return self._bytes(i).decode('utf8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def concat(self, other: 'StringTable') -> 'StringTable':
+        """Appends the strings of other, ids of other are shifted by `len(self)`"""
+        return StringTable(
+            np.concatenate([self.data, other.data]),
+            np.concatenate([self.offsets, other.offsets[1:] + self.offsets[-1]]))
+
+    def resolve(self, ids: Sequence[int]) -> List[str]:
+        """Resolves ids to strings, negative ids resolve to `None`"""
+        return [self[i] for i in ids]
+
+    def build_index(self) -> 'StringTable':
+        """Hashes all strings and sorts the hashes, tables loaded without
+        saved hashes build them once on first lookup"""
+        hashes = np.fromiter((string_hash(self._bytes(i)) for i in range(len(self))),
+                             dtype=np.uint64,
+                             count=len(self))
+        order = np.argsort(hashes, kind='stable')
+        self.hashes, self.order = hashes[order], order.astype(np.int64)
+        return self
+
+    def id(self, s: str) -> int:
+        """Returns id of string or -1 if not interned"""
+        if self.hashes is None:
+            self.build_index()
+        encoded = s.encode('utf8')
+        h = np.uint64(string_hash(encoded))
+        lo = np.searchsorted(self.hashes, h, side='left')
+        hi = np.searchsorted(self.hashes, h, side='right')
+        # compares strings, hashes can collide
+        for i in self.order[lo:hi]:
+            if self._bytes(i) == encoded:
+                return int(i)
+        return -1
+
+    def ids(self, strings: Iterable[str]) -> np.ndarray:
+        """Returns ids of strings, strings not interned get id -1"""
+        return np.array([self.id(s) for s in strings], dtype=np.int64)
+
+    def save(self, path: str, name: str):
+        if self.hashes is None:
+            self.build_index()
+        np.save(f'{path}/{name}-strings.npy', self.data)
+        np.save(f'{path}/{name}-offsets.npy', self.offsets)
+        np.save(f'{path}/{name}-hashes.npy', self.hashes)
+        np.save(f'{path}/{name}-order.npy', self.order)
+
+    @classmethod
+    def load(cls, path: str, name: str, mmap_mode: str = 'r') -> 'StringTable':
+        # tables saved before hashes were persisted build them on first lookup
+        index = [
+            np.load(f'{path}/{name}-{a}.npy', mmap_mode=mmap_mode)
+            if os.path.exists(f'{path}/{name}-{a}.npy') else None
+            for a in ['hashes', 'order']
+        ]
+        return cls(np.load(f'{path}/{name}-strings.npy', mmap_mode=mmap_mode),
+                   np.load(f'{path}/{name}-offsets.npy', mmap_mode=mmap_mode),
+                   *index)
+
+
+class InvertedIndex:
+    """Maps interned keys to postings, the ids of key `k` are
+    `ids[offsets[k]:offsets[k + 1]]`"""
+    def __init__(self, keys: StringTable, offsets: np.ndarray,
+                 ids: np.ndarray):
+        self.keys = keys
+        self.offsets = offsets
+        self.ids = ids
+
+    @classmethod
+    def from_postings(cls, postings: Mapping[str,
+                                             Sequence[int]]) -> 'InvertedIndex':
+        offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        np.cumsum([len(v) for v in postings.values()], out=offsets[1:])
+        ids = np.fromiter((i for v in postings.values() for i in v),
+                          dtype=np.int64,
+                          count=offsets[-1])
+        return cls(StringTable.from_strings(postings.keys()), offsets, ids)
+
+    def merge(self, other: 'InvertedIndex') -> 'InvertedIndex':
+        """Merges postings of other, postings of shared keys are appended"""
+        postings = {
+            k: self.ids[self.offsets[i]:self.offsets[i + 1]]
+            for i, k in enumerate(self.keys)
+        }
+        for i, k in enumerate(other.keys):
+            ids = other.ids[other.offsets[i]:other.offsets[i + 1]]
+            postings[k] = np.concatenate([postings[k], ids]) if k in postings else ids
+        return InvertedIndex.from_postings(postings)
+
+    def get(self, key: str, default: Sequence[int] = ()) -> Sequence[int]:
+        k = self.keys.id(key)
+        if k < 0:
+            return default
+        return self.ids[self.offsets[k]:self.offsets[k + 1]]
+
+    def save(self, path: str, name: str):
+        self.keys.save(path, name)
+        np.save(f'{path}/{name}-postings-offsets.npy', self.offsets)
+        np.save(f'{path}/{name}-postings.npy', self.ids)
+
+    @classmethod
+    def load(cls, path: str, name: str, mmap_mode: str = 'r') -> 'InvertedIndex':
+        return cls(
+            StringTable.load(path, name, mmap_mode),
+            np.load(f'{path}/{name}-postings-offsets.npy', mmap_mode=mmap_mode),
+            np.load(f'{path}/{name}-postings.npy', mmap_mode=mmap_mode))
+
+
+EVENT_RELATIONS = ['HinderedBy', 'isAfter', 'isBefore', 'Causes', 'HasSubevent']
+PHYSICAL_RELATIONS = ['ObjectUse', 'AtLocation', 'MadeUpOf', 'HasProperty']
+ENTITY_RELATIONS = ['CapableOf', 'Desires', 'NotDesires']
+RELATION_GROUPS = ('mental', 'moral', 'event', 'physical', 'entity', 'misc')
+# groups the dialog guiding module turns into knowledge strings
+KNOWLEDGE_GROUPS = ('event', 'mental', 'moral')
+
+
+@lru_cache(maxsize=None)
+def relation_group(relation: str) -> str:
+    """Returns the group of a relation, relations of PersonX are mental and
+    relations of others are moral relations"""
+    if relation.startswith('x'):
+        return 'mental'
+    elif relation.startswith('o'):
+        return 'moral'
+    elif relation in EVENT_RELATIONS:
+        return 'event'
+    elif relation in PHYSICAL_RELATIONS:
+        return 'physical'
+    elif relation in ENTITY_RELATIONS:
+        return 'entity'
+    return 'misc'
+
+
+class Partition(NamedTuple):
+    """Triples of one relation group, head `h` maps to the range
+    `offsets[h]:offsets[h + 1]` of (relation id, tail id) pairs"""
+    offsets: np.ndarray
+    relation_ids: np.ndarray
+    tail_ids: np.ndarray
+
+
+class RelationStore:
+    """Atomic triples grouped by head and partitioned by relation group. All
+    partitions share the head, relation and tail tables, so a head id indexes
+    into every partition."""
+    def __init__(self, heads: StringTable, relations: StringTable,
+                 tails: StringTable, partitions: Mapping[str, Partition]):
+        self.heads = heads
+        self.relations = relations
+        self.tails = tails
+        self.partitions = partitions
+
+    @classmethod
+    def from_frame(cls,
+                   atomic: Dataframe,
+                   head_col: str = 'head',
+                   relation_col: str = 'relation',
+                   tail_col: str = 'relation-text',
+                   drop: Sequence[str] = ('none', '')) -> 'RelationStore':
+        """Builds store from atomic dataframe, tails are interned and missing
+        or uninformative tails are dropped
+
+        Args:
+            atomic - atomic dataframe
+            head_col - column holding heads
+            relation_col - column holding relations
+            tail_col - column holding tails
+            drop - tails that are not stored
+
+        Returns:
+            relation store
+        """
+        df = atomic[atomic[head_col].notna()]
+        tails = df[tail_col].astype(object)
+        keep = tails.notna() & ~tails.str.strip().isin(drop)
+        raw = tails.memory_usage(index=False, deep=True)
+        print(f'Dropping {(~keep).sum()} of {len(df)} missing or uninformative tails')
+        df = df[keep]
+
+        head_ids, heads = pd.factorize(df[head_col])
+        relation_ids, relations = pd.factorize(df[relation_col])
+        tail_ids, tails = pd.factorize(df[tail_col])
+
+        groups = np.array(
+            [RELATION_GROUPS.index(relation_group(r)) for r in relations] +
+            [RELATION_GROUPS.index('misc')])
+        # missing relations index the last entry
+        row_groups = groups[relation_ids]
+
+        partitions = {}
+        for g, name in enumerate(RELATION_GROUPS):
+            rows = np.flatnonzero(row_groups == g)
+            # stable sort keeps the original row order within a head
+            rows = rows[np.argsort(head_ids[rows], kind='stable')]
+            offsets = np.zeros(len(heads) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(head_ids[rows], minlength=len(heads)),
+                      out=offsets[1:])
+            partitions[name] = Partition(offsets,
+                                         relation_ids[rows].astype(np.int32),
+                                         tail_ids[rows].astype(np.int32))
+
+        store = cls(StringTable.from_strings(heads),
+                    StringTable.from_strings(relations),
+                    StringTable.from_strings(tails), partitions)
+        interned = store.tails.nbytes + sum(
+            p.tail_ids.nbytes for p in partitions.values())
+        print(f'Interned {len(tails)} unique tails: {raw / 2**20:.1f} MB as '
+              f'python strings, {interned / 2**20:.1f} MB interned '
+              f'({(raw - interned) / 2**20:.1f} MB saved)')
+        return store
+
+    def __len__(self) -> int:
+        return len(self.heads)
+
+    @staticmethod
+    def _extend_table(table: StringTable,
+                      other: StringTable) -> Tuple[StringTable, np.ndarray]:
+        """Appends strings of other that are not interned yet
+
+        Returns:
+            extended table and the ids of the strings of other in it
+        """
+        ids = table.ids(other)
+        new = np.flatnonzero(ids < 0)
+        ids[new] = len(table) + np.arange(len(new))
+        return table.concat(StringTable.from_strings(other.resolve(new))), ids
+
+    def extend(self,
+               atomic: Dataframe,
+               head_col: str = 'head',
+               relation_col: str = 'relation',
+               tail_col: str = 'relation-text',
+               drop: Sequence[str] = ('none', '')) -> 'RelationStore':
+        """Appends the triples of heads that are not stored yet. New heads,
+        relations and tails get the next ids, existing ids stay valid.
+
+        Args:
+            atomic - atomic dataframe, rows of stored heads are skipped
+            head_col - column holding heads
+            relation_col - column holding relations
+            tail_col - column holding tails
+            drop - tails that are not stored
+
+        Returns:
+            extended relation store
+        """
+        heads = atomic[head_col]
+        unique = heads.dropna().unique()
+        new = set(unique[self.heads.ids(unique) < 0])
+        added = RelationStore.from_frame(atomic[heads.isin(new)], head_col,
+                                         relation_col, tail_col, drop)
+        if len(added) == 0:
+            return self
+
+        relations, relation_ids = self._extend_table(self.relations,
+                                                     added.relations)
+        tails, tail_ids = self._extend_table(self.tails, added.tails)
+        partitions = {}
+        for group, p in self.partitions.items():
+            q = added.partitions[group]
+            partitions[group] = Partition(
+                np.concatenate([p.offsets, q.offsets[1:] + p.offsets[-1]]),
+                np.concatenate([p.relation_ids,
+                                relation_ids[q.relation_ids].astype(np.int32)]),
+                np.concatenate([p.tail_ids,
+                                tail_ids[q.tail_ids].astype(np.int32)]))
+        print(f'Added {len(added)} heads to relation store')
+        return RelationStore(self.heads.concat(added.heads), relations, tails,
+                             partitions)
+
+    def lookup(self,
+               candidates: List[str],
+               groups: Sequence[str] = RELATION_GROUPS,
+               resolve: bool = True,
+               by_group: bool = False) -> List[Knowledge]:
+        """Extracts knowledge relations for a batch of heads, only the
+        partitions of the requested groups are read
+
+        Args:
+            candidates - heads to look up
+            groups - relation groups to extract
+            resolve - if false tails are returned as ids into `tails`
+            by_group - if true relations are kept apart per relation group
+
+        Returns:
+            list of {head: {relation: [tails]}} in order of candidates, or
+            {head: {group: {relation: [tails]}}} if `by_group`
+        """
+        ids = self.heads.ids(candidates)
+        positions = np.flatnonzero(ids >= 0)
+        found = ids[positions]
+
+        entries = [{g: defaultdict(list) for g in groups} for _ in candidates]
+        for group in groups:
+            p = self.partitions[group]
+            edges = gather_ranges(p.offsets, found)
+            lengths = p.offsets[found + 1] - p.offsets[found]
+            owners = np.repeat(positions, lengths).tolist()
+            relations = self.relations.resolve(p.relation_ids[edges])
+            tails = p.tail_ids[edges].tolist()
+            if resolve:
+                tails = self.tails.resolve(tails)
+            for j, r, t in zip(owners, relations, tails):
+                entries[j][group][r].append(t)
+
+        if by_group:
+            return [{c: e} for c, e in zip(candidates, entries)]
+        merged = [defaultdict(list) for _ in candidates]
+        for m, e in zip(merged, entries):
+            for relations in e.values():
+                for r, t in relations.items():
+                    m[r].extend(t)
+        return [{c: m} for c, m in zip(candidates, merged)]
+
+    def save(self, path: str = f'{DATA_ROOT}/atomic/relation_store'):
+        os.makedirs(path, exist_ok=True)
+        self.heads.save(path, 'heads')
+        self.relations.save(path, 'relations')
+        self.tails.save(path, 'tails')
+        for group, p in self.partitions.items():
+            for name, array in p._asdict().items():
+                np.save(f'{path}/{group}-{name}.npy', array)
+
+    @classmethod
+    def load(cls,
+             path: str = f'{DATA_ROOT}/atomic/relation_store',
+             mmap_mode: str = 'r') -> 'RelationStore':
+        return cls(
+            StringTable.load(path, 'heads', mmap_mode),
+            StringTable.load(path, 'relations', mmap_mode),
+            StringTable.load(path, 'tails', mmap_mode), {
+                group: Partition(*(np.load(f'{path}/{group}-{name}.npy',
+                                           mmap_mode=mmap_mode)
+                                   for name in Partition._fields))
+                for group in RELATION_GROUPS
+            })
+
+
+def build_relation_store(
+        path: str = f'{DATA_ROOT}/atomic/processed.tsv',
+        save_to: str = f'{DATA_ROOT}/atomic/relation_store') -> RelationStore:
+    """Builds relation store from processed atomic data
+
+    Args:
+        path - path to processed atomic tsv
+        save_to - directory to save store to, if `None` the store is not saved
+
+    Returns:
+        relation store
+    """
+    store = RelationStore.from_frame(read_tsv(path))
+    if save_to is not None:
+        store.save(save_to)
+    return store
+
+
+if __name__ == "__main__":
+    build_relation_store()
@@ -0,0 +1,110 @@
+"""Sharded outputs with a progress manifest, so long running jobs can resume"""
+
+import hashlib
+import json
+import os
+from typing import Any, Iterable, Iterator, List, Mapping
+
+
+def content_hash(items: Iterable[Any]) -> str:
+    """Hashes items in order, stored in the manifest meta a job on changed
+    input starts over instead of resuming"""
+    h = hashlib.sha1()
+    for item in items:
+        h.update(str(item).encode('utf8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class ShardManifest:
+    """Tracks completed shards of a job in `manifest.json` next to the shards.
+    Items are split into fixed-size shards, shard `i` holds the items
+    `i * shard_size:(i + 1) * shard_size`."""
+    def __init__(self,
+                 path: str,
+                 n_items: int,
+                 shard_size: int,
+                 meta: Mapping[str, Any] = None):
+        """Opens manifest and resumes from it if the job did not change
+
+        Args:
+            path - directory holding shards and manifest
+            n_items - total number of items to process
+            shard_size - number of items per shard
+            meta - job settings and input hash, a change starts the job over
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.n_items = n_items
+        self.shard_size = shard_size
+        self.meta = dict(meta or {})
+        self.completed = set()
+
+        manifest = self._read(path)
+        if manifest is not None and (manifest['n_items'], manifest['shard_size'],
+                                     manifest['meta']) == (n_items, shard_size,
+                                                           self.meta):
+            self.completed = set(manifest['completed'])
+            print(f'Resuming from {len(self.completed)}/{self.n_shards} shards')
+        elif manifest is not None:
+            print(f'Job in {path} changed, starting over')
+
+    @staticmethod
+    def _read(path: str) -> Mapping[str, Any]:
+        try:
+            with open(f'{path}/manifest.json', 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def open(cls, path: str) -> 'ShardManifest':
+        """Opens existing manifest read-only for reading shards, nothing is
+        logged or created"""
+        manifest = cls._read(path)
+        if manifest is None:
+            raise FileNotFoundError(f'No manifest found in {path}')
+        self = cls.__new__(cls)
+        self.path = path
+        self.n_items = manifest['n_items']
+        self.shard_size = manifest['shard_size']
+        self.meta = manifest['meta']
+        self.completed = set(manifest['completed'])
+        return self
+
+    @property
+    def n_shards(self) -> int:
+        return -(-self.n_items // self.shard_size)
+
+    @property
+    def done(self) -> bool:
+        return len(self.completed) == self.n_shards
+
+    def bounds(self, shard: int) -> slice:
+        """Item range of shard"""
+        return slice(shard * self.shard_size,
+                     min((shard + 1) * self.shard_size, self.n_items))
+
+    def shard_path(self, shard: int, suffix: str = '.pickle') -> str:
+        return f'{self.path}/shard-{shard:05d}{suffix}'
+
+    def pending(self) -> List[int]:
+        return [i for i in range(self.n_shards) if i not in self.completed]
+
+    def complete(self, shard: int):
+        """Marks shard as completed, the manifest is replaced atomically"""
+        self.completed.add(shard)
+        tmp = f'{self.path}/manifest.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(
+                {
+                    'n_items': self.n_items,
+                    'shard_size': self.shard_size,
+                    'meta': self.meta,
+                    'completed': sorted(self.completed)
+                }, f)
+        os.replace(tmp, f'{self.path}/manifest.json')
+
+    def shards(self, suffix: str = '.pickle') -> Iterator[str]:
+        """Paths of completed shards in order"""
+        return (self.shard_path(i, suffix) for i in sorted(self.completed))
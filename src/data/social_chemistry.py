@@ -1,27 +1,53 @@
 import pickle
-from typing import List
+from typing import Any, Iterator, List
 
 from tqdm.std import tqdm
 from src_old.constants import DATA_ROOT
+from src_old.data.columnar import encode, load_cached
+from src_old.data.parse_store import ParseStore, read_parse_stores, relation_frame
+from src_old.data.shards import ShardManifest, content_hash
 from src_old.utils import read_tsv
 import pandas as pd
 
 Dataframe = pd.DataFrame
 
 
+def read_social_chemistry_files(files: List[str]) -> Dataframe:
+    """Reads social chemistry tsv files
+
+    Args:
+        files - social chemistry tsv files
+
+    Returns:
+        social chemistry dataframe with low-cardinality columns as categoricals
+    """
+    df = pd.concat([read_tsv(f) for f in files],
+                   ignore_index=True).convert_dtypes()
+    return encode(df)
+
+
 def load_social_chemistry_data(
         path: str = f'{DATA_ROOT}/social_chemistry/social-chem-101.v1.0.tsv',
-        save: bool = False) -> Dataframe:
+        save: bool = False,
+        cache: str = f'{DATA_ROOT}/social_chemistry/kb',
+        columns: List[str] = None) -> Dataframe:
     """Load social chemistry dataset from glob path
 
     Args:
         path - path to social chemistry file
         save - if true saves dataframe to disk
+        cache - directory of the columnar build, rebuilt when the source file
+            changes, if `None` the tsv file is read directly
+        columns - columns to load, defaults to all
 
     Returns:
         social chemistry dataframe
     """
-    df = read_tsv(path).convert_dtypes()
+    if cache is None:
+        df = read_social_chemistry_files([path])
+        df = df if columns is None else df[columns]
+    else:
+        df = load_cached([path], cache, read_social_chemistry_files, columns)
 
     if save:
         df_path = f'{DATA_ROOT}/social_chemistry/processed.tsv'
@@ -47,13 +73,25 @@ def extract_rot(from_action: str):
 def parse(soc_chem: Dataframe,
           parse_type: str,
           col: List[str],
-          save: bool = True) -> Dataframe:
-    """Apply parse function on atomic heads
+          save: bool = True,
+          save_to: str = f'{DATA_ROOT}/social_chemistry',
+          shard_size: int = 20000,
+          n_process: int = 4,
+          batch_size: int = 256) -> Dataframe:
+    """Apply parse function on social chemistry columns. Parses of every column
+    are written to `{save_to}/parse-{column}-{parse_type}` in fixed-size shards
+    with a manifest, a restarted job resumes after the last completed shard.
+    Dependency parses are stored as columnar `ParseStore` shards, srl parses as pickles.
 
     Args:
-        atomic - atomic dataframe
+        soc_chem - social chemistry dataframe
         parse_type - possible parse types: srl, dp
-        save - if true saves dataframe to disk
+        col - columns to parse
+        save - if true saves parses to disk
+        save_to - directory holding the shard directories
+        shard_size - number of unique texts per shard
+        n_process - number of spacy worker processes
+        batch_size - number of texts per spacy or srl batch
 
     Returns:
         dataframe with added parse column
@@ -64,73 +102,104 @@ def parse(soc_chem: Dataframe,
 
     # load and destroy on-demand
     if parse_type == 'srl':
-        from src_old.nlp import srl
-        fn = srl
-        del srl
+        from src_old.nlp import srl_batch
+
+        def fn(texts: List[str]) -> list:
+            return [
+                p for i in range(0, len(texts), batch_size)
+                for p in srl_batch(texts[i:i + batch_size])
+            ]
     elif parse_type == 'dp':
-        import spacy
-        # tokens cannot be pickled
-        nlp = spacy.load('en_core_web_lg')
-        fn = nlp
+        from src_old.nlp import get_nlp, DEPENDENCY_PIPES
+        nlp = get_nlp(DEPENDENCY_PIPES)
+
+        def fn(texts: List[str]) -> list:
+            return nlp.pipe(texts, n_process=n_process, batch_size=batch_size)
 
     df = soc_chem
     print(f'Start {parse_type} parsing')
     for c in col:
-        parses = {}
-        for i, t in enumerate(tqdm(df[c].unique()), start=0):
-            if isinstance(t, str):
-                tmp = fn(t) if t != '' else None
-            else:
-                tmp = None
-
-            if i % 500 == 0:
-                print('Sample :', tmp)
-            parses[t] = tmp
-
-        if save:
-            with open(
-                    f'{DATA_ROOT}/social_chemistry/parse-{col}-{parse_type}.pickle',
-                    'wb') as p:
-                pickle.dump(parses, p)
+        texts = [t for t in df[c].unique() if isinstance(t, str) and t != '']
+        manifest = ShardManifest(f'{save_to}/parse-{c}-{parse_type}',
+                                 len(texts),
+                                 shard_size,
+                                 meta={
+                                     'column': c,
+                                     'parse_type': parse_type,
+                                     'input': content_hash(texts),
+                                     'storage': 'parse_store'
+                                     if parse_type == 'dp' else 'pickle'
+                                 })
+
+        for shard in tqdm(manifest.pending()):
+            bounds = manifest.bounds(shard)
+            if parse_type == 'dp':
+                store = ParseStore.from_docs(fn(texts[bounds]))
+                print('Sample :', store.texts[0], store.sentence(0))
+                if save:
+                    store.save(manifest.shard_path(shard, suffix=''))
+                    manifest.complete(shard)
+                continue
+
+            parses = dict(zip(texts[bounds], fn(texts[bounds])))
+            print('Sample :', next(iter(parses.items())))
+            if save:
+                with open(manifest.shard_path(shard), 'wb') as p:
+                    pickle.dump(parses, p)
+                manifest.complete(shard)
     return df
 
 
-def find_relations(soc_chem: Dataframe, column: str) -> Dataframe:
+def read_parses(column: str,
+                parse_type: str = 'dp',
+                path: str = f'{DATA_ROOT}/social_chemistry',
+                mmap_mode: str = 'r') -> Iterator[Any]:
+    """Streams the parse shards of a column one at a time
+
+    Args:
+        column - parsed column
+        parse_type - possible parse types: srl, dp
+        path - directory holding the shard directories
+        mmap_mode - numpy memory map mode of dependency parses, `None` loads into memory
+
+    Returns:
+        iterator over parse stores for dp, over text and srl parse pairs for srl
+    """
+    path = f'{path}/parse-{column}-{parse_type}'
+    if parse_type == 'dp':
+        yield from read_parse_stores(path, mmap_mode)
+        return
+
+    for f in ShardManifest.open(path).shards():
+        with open(f, 'rb') as p:
+            yield from pickle.load(p).items()
+
+
+def find_relations(soc_chem: Dataframe,
+                   column: str,
+                   parses: str = None,
+                   n_workers: int = 4) -> Dataframe:
     """Go through social chemistry situation or action parses and extract objects to look up in head
 
     Args:
         social chemistry - social chemistry dataframe
+        column - parsed column
+        parses - parse store of `column`, defaults to `social_chemistry/parse-{column}-dp`
+        n_workers - number of processes extracting shards without saved relation columns
 
     Returns:
-        dataframe with objects and verbs as columns added
+        dataframe with lists of objects (dobj, pobj) and verb lemmas as columns added
     """
     assert column in soc_chem.columns
     df = soc_chem
     col = column
-    obj_extraction = []
-    verb_extraction = []
-
-    for sample in df[col]:
-        obj_tmp = []
-        verb_tmp = []
-        # go through tokens in sentence
-        for parse in sample:
-            if 'dobj' in parse.dep or 'pobj' in parse.dep:
-                obj_tmp.append(parse.text)
-                print(f'Sample found in {sample}: {parse.text}')
-            else:
-                obj_tmp.append(None)
-
-            if 'verb' in parse.tag:
-                verb_tmp.append(None)
-            else:
-                verb_tmp.append(None)
-
-        obj_extraction.append(obj_tmp)
-        verb_extraction.append(verb_tmp)
-
-    df['objects'] = obj_extraction
-    df['verbs'] = verb_extraction
+    if parses is None:
+        parses = f'{DATA_ROOT}/social_chemistry/parse-{col}-dp'
+
+    # objects and verb lemmas of every parsed text
+    relations = relation_frame(parses, n_workers)
+    df['objects'] = df[col].map(relations['objects'])
+    df['verbs'] = df[col].map(relations['verbs'])
 
     return df
 
@@ -8,13 +8,56 @@ from torch import Tensor
 from torch import nn
 from transformers import AutoTokenizer, AutoModelWithLMHead, T5ForConditionalGeneration, AutoModelForSequenceClassification
 
-from src_old.constants import T5_TURN_TEMPLATES
-from src_old.knowledge_extraction import extract_from_atomic, retrieve_overlap
+from src_old.constants import ATOMIC_KNOWLEDGE_BASE, T5_TURN_TEMPLATES
+from src_old.data.cache import RetrievalCache, knowledge_base_version
+from src_old.data.relation_store import KNOWLEDGE_GROUPS, StringTable
+from src_old.knowledge_extraction import extract_from_atomic, kb, retrieve_overlap, retrieve_overlap_batch
 from src_old.models.dialog_guiding_module.knowledge_transformer import KnowledgeAttention, KnowledgeAttentionEncoder
 from src_old.models.dialog_transformer import DialogTransformer
 from src_old.utils import freeze_weights
 
 
+# marks retrieval cache misses, cached knowledge can be `None`
+_MISS = object()
+
+
+def prepare_relations(
+        samples: Iterable[Mapping[str, Mapping[str, Mapping[str, List[Union[str, int]]]]]],
+        tails: StringTable = None) -> Tuple[str]:
+    """Extracts all the information from retrieved Atomic graph and prepares strings
+
+    Args:
+        samples - samples to extract knowledge from, relations grouped by
+            relation group as returned by `RelationStore.lookup` with `by_group`
+        tails - tail table of the relation store, if given tails are ids
+            resolved into strings here
+
+    Returns:
+        knowledge encoded strings to be encoded
+    """
+    if samples is None:
+        return ('none', 'none', 'none')
+
+    knowledge = dict.fromkeys(KNOWLEDGE_GROUPS, '')
+
+    def extract(v: Iterable[Union[str, int]]) -> str:
+        # the store holds no missing or `none` tails
+        if tails is not None:
+            return ' '.join(tails.resolve(v))
+        v = list(filter(lambda x: isinstance(x, str), v))
+        return ' '.join((t for t in v if t != 'none'))
+
+    for sample in samples:
+        for groups in sample.values():
+            # mental, moral and event relations
+            for group in KNOWLEDGE_GROUPS:
+                for k, v in groups.get(group, {}).items():
+                    knowledge[group] += f' [{k}] ' + extract(v)
+
+    return (knowledge['event'].strip(), knowledge['mental'].strip(),
+            knowledge['moral'].strip())
+
+
 class DialogGuidingModule(nn.Module):
     def __init__(self,
                  d_model: int = 768,
@@ -22,6 +65,8 @@ class DialogGuidingModule(nn.Module):
                  soc_chem_checkpoint:
                  str = 'src_old/models/social-chemistry-101/rot_checkpoint',
                  hf_checkpoint: str = 'distilbert-base-uncased',
+                 retrieval_cache: str = None,
+                 frame_extractor: str = 'srl',
                  device: torch.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')):
         """DialogGuidingModule which extracts knowledge from Atomic, predicts next turn type
         and encodes knowledge via attention heads pointing to pre-Language Model encoder
@@ -30,12 +75,21 @@ class DialogGuidingModule(nn.Module):
             d_model - embedding dimensions
             output_dimensions - outform transformation for language model head capability
             hf_checkpoint - huggingface checkpoint for tokenizer
+            retrieval_cache - path to persistent retrieval cache, if `None` nothing is cached
+            frame_extractor - verb frames used for retrieval: srl, dependency
         """
 
         super(DialogGuidingModule, self).__init__()
 
         # predict next turn and prepend template
         self.device = device
+        self.frame_extractor = frame_extractor
+        self.retrieval_cache = None
+        if retrieval_cache is not None:
+            self.retrieval_cache = RetrievalCache(
+                retrieval_cache,
+                version=
+                f'{knowledge_base_version(ATOMIC_KNOWLEDGE_BASE)}-{frame_extractor}-groups')
         self.templates = T5_TURN_TEMPLATES
         self.next_turn_predictor = AutoModelForSequenceClassification.from_pretrained(
             hf_checkpoint)
@@ -145,11 +199,60 @@ class DialogGuidingModule(nn.Module):
 
         ####
 
-        overlaps = retrieve_overlap(query)
+        overlaps = retrieve_overlap(query,
+                                    frame_extractor=self.frame_extractor)
         if overlaps is None:
             return None
 
-        return extract_from_atomic(overlaps)
+        return extract_from_atomic(overlaps, KNOWLEDGE_GROUPS, False, True)
+
+    def _cached_knowledge_lookup(
+            self,
+            query: str) -> Iterable[Mapping[str, Mapping[str, List[str]]]]:
+        """Receives knowledge from retrieval cache or from Atomic graph on a miss
+
+        Args:
+            query - query to search
+
+        Returns:
+            knowledge mappings
+        """
+        if self.retrieval_cache is None:
+            return self._knowledge_lookup(query)
+
+        s = self.retrieval_cache.get(query, default=_MISS)
+        if s is _MISS:
+            s = self._knowledge_lookup(query)
+            self.retrieval_cache.put(query, s)
+        return s
+
+    def _knowledge_lookup_batch(
+        self, queries: List[str]
+    ) -> List[Iterable[Mapping[str, Mapping[str, List[str]]]]]:
+        """Receives knowledge from Atomic graph for a batch of queries
+
+        Args:
+            queries - queries to search
+
+        Returns:
+            knowledge mappings per query
+        """
+        res = [_MISS] * len(queries)
+        if self.retrieval_cache is not None:
+            res = [self.retrieval_cache.get(q, default=_MISS) for q in queries]
+
+        misses = [i for i, s in enumerate(res) if s is _MISS]
+        if not misses:
+            return res
+
+        overlaps = retrieve_overlap_batch([queries[i] for i in misses],
+                                          frame_extractor=self.frame_extractor)
+        for i, o in zip(misses, overlaps):
+            res[i] = None if o is None else extract_from_atomic(
+                o, KNOWLEDGE_GROUPS, False, True)
+            if self.retrieval_cache is not None:
+                self.retrieval_cache.put(queries[i], res[i])
+        return res
 
     def _prepare_relations(
         self, samples: Iterable[Mapping[str,
@@ -163,37 +266,7 @@ class DialogGuidingModule(nn.Module):
         Returns:
             knowledge encoded strings to be encoded
         """
-        if samples is None:
-            return ('none', 'none', 'none')
-
-        mental = ''
-        event = ''
-        moral = ''
-
-        def extract(tails: Iterable[str]) -> str:
-            tails = list(filter(lambda x: isinstance(x, str), tails))
-            return ' '.join((t for t in tails if t != 'none'))
-
-        for sample in samples:
-            for entry in sample.values():
-                for k, v in entry.items():
-                    # mental relations
-                    if k.startswith('x'):
-                        mental += f' [{k}] '
-                        mental += extract(v)
-                    # moral relations
-                    elif k.startswith('o'):
-                        moral += f' [{k}] '
-                        moral += extract(v)
-                    # event relations
-                    elif k in [
-                            'HinderedBy', 'isAfter', 'isBefore', 'Causes',
-                            'HasSubevent'
-                    ]:
-                        event += f' [{k}] '
-                        event += extract(v)
-
-        return (event.strip(), mental.strip(), moral.strip())
+        return prepare_relations(samples, kb.relation_store.tails)
 
     def parse(self, string_repr: str) -> Tuple[str]:
         """Extract and prepare
@@ -205,7 +278,7 @@ class DialogGuidingModule(nn.Module):
         with open('evaluation/retrieval.txt', 'a+') as f:
             f.write(f'Input Turn: {string_repr}\n')
             f.write('=' * 80 + '\n')
-            s = self._knowledge_lookup(string_repr)
+            s = self._cached_knowledge_lookup(string_repr)
             if s is not None:
                 for sample in s:
                     for head in sample.keys():
@@ -213,17 +286,40 @@ class DialogGuidingModule(nn.Module):
 
         return self._prepare_relations(s)
 
-    def forward(self, x: Tensor, string_repr: str, mask: Tensor = None):
+    def parse_batch(self, string_reprs: List[str]) -> List[Tuple[str]]:
+        """Extract and prepare a batch of turns
+
+        Args:
+            string_reprs - string representations of current input turns
+
+        Returns:
+            prepared relations per turn in order
+        """
+        return [
+            self._prepare_relations(s)
+            for s in self._knowledge_lookup_batch(string_reprs)
+        ]
+
+    def forward(self,
+                x: Tensor,
+                string_repr: str,
+                mask: Tensor = None,
+                knowledge: Tuple[str] = None,
+                turn_type: int = None):
         """Forward pass through `DialogGuidingModule`
 
         Args:
             x - input representation of `DialogTransformer`
             string_repr - string representation of current utterance
+            knowledge - precomputed (event, mental, moral) strings, skips live retrieval
+            turn_type - precomputed next turn type, skips turn classification
 
         Returns:
             encoded representation for language model head
         """
-        event, mental, moral = self.parse(string_repr)
+        if knowledge is None:
+            knowledge = self.parse(string_repr)
+        event, mental, moral = knowledge
         knowledge = self.knowledge_attention(x,
                                              event=event,
                                              mental=mental,
@@ -236,8 +332,10 @@ class DialogGuidingModule(nn.Module):
         knowledge['moral'] = moral
 
         # add batch encoding
-        next_turn_type = int(
-            self._classify_next_turn_type(string_repr).cpu().detach().numpy())
+        next_turn_type = turn_type
+        if next_turn_type is None:
+            next_turn_type = int(
+                self._classify_next_turn_type(string_repr).cpu().detach().numpy())
         new_representation = self.templates[next_turn_type] + string_repr
         with open('evaluation/turn.txt', 'a+') as f:
             f.write(f'{string_repr} -> {new_representation}\n')
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from pprint import pprint
-from typing import Iterable
+from typing import Iterable, Tuple
 
 import torch
 from torch import Tensor
@@ -29,6 +29,8 @@ class ModelConfig:
     output_dimensions: int = 768
     soc_chem_checkpoint: str = 'checkpoints/rot_checkpoint'
     hf_checkpoint: str = 'benjaminbeilharz/bert-base-uncased-next-turn-classifier'
+    retrieval_cache: str = None
+    frame_extractor: str = 'srl'
 
     # language model head
     lm_checkpoint: str = 'benjaminbeilharz/t5-conditioned-next-turn'
@@ -76,7 +78,9 @@ class NeuralEmpathy(nn.Module):
             d_model=self.cfg.d_model,
             output_dimensions=self.cfg.output_dimensions,
             soc_chem_checkpoint=self.cfg.soc_chem_checkpoint,
-            hf_checkpoint=self.cfg.hf_checkpoint).to(self.cfg.device)
+            hf_checkpoint=self.cfg.hf_checkpoint,
+            retrieval_cache=self.cfg.retrieval_cache,
+            frame_extractor=self.cfg.frame_extractor).to(self.cfg.device)
 
 
         # create language model head
@@ -123,12 +127,19 @@ class NeuralEmpathy(nn.Module):
         labels[labels == self.lm_tokenizer.pad_token_id] = -100
         return labels.to(self.cfg.device)
 
-    def inference(self, history: str, turn: str, **generation_settings) -> Iterable[str]:
+    def inference(self,
+                  history: str,
+                  turn: str,
+                  knowledge: Tuple[str] = None,
+                  turn_type: int = None,
+                  **generation_settings) -> Iterable[str]:
         """Inference step to generate a response
 
         Args:
             history - dialog history
             turn - current input
+            knowledge - precomputed (event, mental, moral) strings of current input
+            turn_type - precomputed next turn type
             generation_settings - generation strategy to let language model generate
         
         Returns:
@@ -151,7 +162,9 @@ class NeuralEmpathy(nn.Module):
             encoded_history = self.dialog_transformer(history, turn)
 
         # knowledge attention w/ atomic
-        knowledge_encoding, attention_mask = self.dialog_guiding_module(encoded_history, turn)
+        knowledge_encoding, attention_mask = self.dialog_guiding_module(encoded_history, turn,
+                knowledge=knowledge,
+                turn_type=turn_type)
         knowledge_encoding2tokens = torch.argmax(knowledge_encoding, dim=-1)
 
         # if settings are not supplied, use default arguments to generate
@@ -175,13 +188,20 @@ class NeuralEmpathy(nn.Module):
         return generations
 
 
-    def forward(self, history: str, turn: str, nxt: str) -> Seq2SeqLMOutput:
+    def forward(self,
+                history: str,
+                turn: str,
+                nxt: str,
+                knowledge: Tuple[str] = None,
+                turn_type: int = None) -> Seq2SeqLMOutput:
         """Forward pass
         
         Args:
             history - dialog history
             turn - current utterance
             next - gold label for response to current utterance
+            knowledge - precomputed (event, mental, moral) strings of current utterance
+            turn_type - precomputed next turn type
 
         Returns:
             logits, loss in `Seq2SeqLMOutput`
@@ -205,7 +225,9 @@ class NeuralEmpathy(nn.Module):
         # knowledge attention w/ atomic
         knowledge_encoding, attention_mask = self.dialog_guiding_module(encoded_history, turn, 
                 # experimental
-                mask=~dec_in.attention_mask.to(torch.bool))
+                mask=~dec_in.attention_mask.to(torch.bool),
+                knowledge=knowledge,
+                turn_type=turn_type)
 
         # language model head - prepare gold label
         if 't5' in self.cfg.lm_checkpoint:
@@ -1,36 +1,78 @@
 from collections import defaultdict
+from functools import lru_cache
+from pathlib import Path
 from typing import Callable, Dict, Tuple, Mapping, NamedTuple, Set, Union, List
 
 from allennlp.predictors.predictor import Predictor
-# is needed for the predictor class
-import allennlp_models.tagging
 import pandas as pd
 import spacy
 import spacy.symbols as S
 from spacy import displacy
+from spacy.language import Language
 from spacy.tokens.doc import Doc
 from spacy.tokens.token import Token
 
-from src_old.constants import DATA_ROOT
+from src_old.constants import DATA_ROOT, SPACY_MODEL, SRL_MODEL
 from src_old.utils import sorted_dict, freeze_weights
 from src_old.data.save import to_pickle
 
 # dtypes and constants
-try:
-    NLP = spacy.load('en_core_web_lg')
-except:
-    from subprocess import call
-    call('python -m spacy download en_core_web_lg'.split(' '))
-    del call
-    NLP = spacy.load('en_core_web_lg')
-
 Dataframe = pd.DataFrame
 Data = Mapping[int, NamedTuple]
-# allennlp srl model
 
-SRLPREDICTOR = Predictor.from_path(
-    "https://storage.googleapis.com/allennlp-public-models/structured-prediction-srl-bert.2020.12.15.tar.gz"
-)
+# pipeline components needed for dependency parses with coarse POS tags and lemmas
+DEPENDENCY_PIPES = ('tok2vec', 'tagger', 'parser', 'attribute_ruler', 'lemmatizer')
+# pipeline components needed for rule-based lemmatization
+LEMMA_PIPES = ('tok2vec', 'tagger', 'attribute_ruler', 'lemmatizer')
+
+
+def _pipeline_components(name: str) -> List[str]:
+    """Reads component names from the model meta without loading the model"""
+    if spacy.util.is_package(name):
+        path = spacy.util.get_package_path(name)
+    else:
+        path = Path(name)
+    meta = spacy.util.get_model_meta(path)
+    return meta.get('components', meta['pipeline'])
+
+
+@lru_cache(maxsize=None)
+def get_nlp(components: Tuple[str, ...] = None,
+            name: str = SPACY_MODEL) -> Language:
+    """Returns process-wide spacy pipeline, loaded on first use.
+    Components not asked for are excluded and never loaded.
+
+    Args:
+        components: pipeline components to load, `None` loads all of them
+        name: installed spacy package or path to a local model directory
+
+    Returns:
+        spacy pipeline
+    """
+    if not spacy.util.is_package(name) and not Path(name).exists():
+        from subprocess import call
+        call(f'python -m spacy download {name}'.split(' '))
+        del call
+
+    exclude = []
+    if components is not None:
+        exclude = [c for c in _pipeline_components(name) if c not in components]
+    return spacy.load(name, exclude=exclude)
+
+
+@lru_cache(maxsize=None)
+def get_srl_predictor(path: str = SRL_MODEL) -> Predictor:
+    """Returns process-wide allennlp srl predictor, loaded on first use
+
+    Args:
+        path: url or path to a local model archive
+
+    Returns:
+        srl predictor
+    """
+    # is needed for the predictor class
+    import allennlp_models.tagging
+    return Predictor.from_path(path)
 
 
 class DependencyParse(NamedTuple):
@@ -80,9 +122,10 @@ def dependency_parse(
             - `Spacy` document class
     """
     # IMPORTANT! tokens cannot be pickled, must pickle Doc instead
+    nlp = get_nlp(DEPENDENCY_PIPES)
     if isinstance(from_sentences, list):
         sentence, origin = from_sentences
-        doc = NLP(sentence)
+        doc = nlp(sentence)
         parse = {
             doc: {
                 'origin': origin,
@@ -91,7 +134,7 @@ def dependency_parse(
         }
     elif isinstance(from_sentences, str):
         sentence = from_sentences
-        doc = NLP(sentence)
+        doc = nlp(sentence)
         parse = {doc: '-'.join(t.dep_ for t in doc)}
 
     if return_dep:
@@ -120,8 +163,9 @@ def extract_verbs(from_data: Union[Dataframe, Data, set], column: str,
     if isinstance(from_data, pd.DataFrame):
         data = from_data[column]
     data = from_data
+    nlp = get_nlp(DEPENDENCY_PIPES)
     for i in data:
-        doc = NLP(i)
+        doc = nlp(i)
         for t in doc:
             if t.dep == dependent_on and t.head.pos == S.VERB:
                 verbs.add(t.head.lemma_)
@@ -143,10 +187,9 @@ def extract_dependency_parses(
     """
     ddict = defaultdict(list)
     cdict = defaultdict(int)
-    if NLP is None:
-        NLP = spacy.load('en_core_web_lg')
+    nlp = get_nlp(DEPENDENCY_PIPES)
     for i in list(set(from_data[column])):
-        doc = NLP(i)
+        doc = nlp(i)
         i = '-'.join([t.dep_ for t in doc])
         ddict[i].append(doc.text)
         cdict[i] += 1
@@ -170,8 +213,9 @@ def noun_chunking(from_data: Union[Dataframe, Data],
     """
 
     ddict = defaultdict(list)
+    nlp = get_nlp(DEPENDENCY_PIPES)
     for i in list(set(from_data[column])):
-        doc = NLP(i)
+        doc = nlp(i)
         ddict[doc.text] = [
             NounChunk(c.text, c.root.head.text, c.root.head.pos_,
                       c.root.head.dep_) for c in doc.noun_chunks
@@ -180,6 +224,20 @@ def noun_chunking(from_data: Union[Dataframe, Data],
     return ddict
 
 
+@lru_cache(maxsize=8192)
+def lemmatize(word: str) -> str:
+    """Lemmatizes a single word, only running the components needed for lemmas.
+    Results are cached, since the same verbs are looked up over and over again.
+
+    Args:
+        word: word to lemmatize
+
+    Returns:
+        lemma of the first token
+    """
+    return get_nlp(LEMMA_PIPES)(word)[0].lemma_
+
+
 def display_dependency_parse(doc: Doc):
     """Renders dependency parse
 
@@ -190,15 +248,18 @@ def display_dependency_parse(doc: Doc):
 
 
 def srl(sentence: str,
-        predictor: Predictor = SRLPREDICTOR) -> List[SemanticRoleLabel]:
+        predictor: Predictor = None) -> List[SemanticRoleLabel]:
     """Uses AllenNLP semantic role labeling model to tag sentence
 
     Args:
         text: sentence to tag
+        predictor: srl predictor, defaults to the process-wide predictor
 
     Returns:
         dictionionary with tokenized verb frames tagged with semantic roles
     """
+    if predictor is None:
+        predictor = get_srl_predictor()
 
     pred = predictor.predict(sentence=sentence)
     verbs = []
@@ -207,3 +268,110 @@ def srl(sentence: str,
             SemanticRoleLabel(verb['description'], verb['verb'], verb['tags']))
 
     return verbs
+
+
+def srl_batch(sentences: List[str],
+              predictor: Predictor = None) -> List[List[SemanticRoleLabel]]:
+    """Batched version of `srl` using the predictor's batch api
+
+    Args:
+        sentences: sentences to tag
+        predictor: srl predictor, defaults to the process-wide predictor
+
+    Returns:
+        list of verb frames tagged with semantic roles per sentence
+    """
+    if predictor is None:
+        predictor = get_srl_predictor()
+
+    preds = predictor.predict_batch_json([{'sentence': s} for s in sentences])
+    return [[
+        SemanticRoleLabel(verb['description'], verb['verb'], verb['tags'])
+        for verb in pred['verbs']
+    ] for pred in preds]
+
+
+# dependency labels mapped to the semantic roles used by `dependency_frames`
+DEPENDENCY_ROLES = {
+    'nsubj': 'ARG0',
+    'csubj': 'ARG0',
+    'agent': 'ARG0',
+    'nsubjpass': 'ARG1',
+    'csubjpass': 'ARG1',
+    'dobj': 'ARG1',
+    'attr': 'ARG1',
+    'oprd': 'ARG1',
+    'acomp': 'ARG1',
+    'ccomp': 'ARG1',
+    'xcomp': 'ARG1',
+    'dative': 'ARG2',
+    # modifiers use srl labels, so phrase extraction filters both extractors
+    # the same way, the modifier type is approximated by the dependency
+    'prep': 'ARGM-LOC',
+    'advmod': 'ARGM-MNR',
+    'npadvmod': 'ARGM-TMP',
+    'advcl': 'ARGM-ADV',
+    'neg': 'ARGM-NEG',
+}
+
+
+def _dependency_frame(doc: Doc, verb: Token) -> SemanticRoleLabel:
+    """Builds an srl-like frame from a verb and the subtrees of its arguments"""
+    tags = ['O'] * len(doc)
+    tags[verb.i] = 'B-V'
+    for child in verb.children:
+        role = DEPENDENCY_ROLES.get(child.dep_)
+        if role is None:
+            continue
+        start, end = child.left_edge.i, child.right_edge.i + 1
+        # subtrees of non-projective parses can cover the verb
+        if start <= verb.i < end:
+            continue
+        tags[start:end] = [f'B-{role}'] + [f'I-{role}'] * (end - start - 1)
+
+    # a span cut by an overlapping argument starts again with `B-`
+    for i, tag in enumerate(tags):
+        if tag.startswith('I-') and (i == 0 or tags[i - 1][2:] != tag[2:]):
+            tags[i] = f'B-{tag[2:]}'
+
+    # same format as allennlp descriptions: [ARG0: I] [V: feel] ...
+    spans = []
+    for t, tag in zip(doc, tags):
+        if tag.startswith('I-'):
+            spans[-1][1].append(t.text)
+        else:
+            spans.append((tag[2:], [t.text]))
+    description = ' '.join(f'[{role}: {" ".join(words)}]' if role else words[0]
+                           for role, words in spans)
+
+    return SemanticRoleLabel(description, verb.text, tags)
+
+
+def dependency_frames(sentence: str) -> List[SemanticRoleLabel]:
+    """Fast substitute for `srl`, frames are built from the dependency parse
+    by taking verbs and the subtrees of their arguments
+
+    Args:
+        sentence: sentence to tag
+
+    Returns:
+        verb frames in the same format as `srl`
+    """
+    doc = get_nlp(DEPENDENCY_PIPES)(sentence)
+    return [_dependency_frame(doc, t) for t in doc if t.pos == S.VERB]
+
+
+def dependency_frames_batch(sentences: List[str],
+                            batch_size: int = 256) -> List[List[SemanticRoleLabel]]:
+    """Batched version of `dependency_frames`
+
+    Args:
+        sentences: sentences to tag
+        batch_size: spacy batch size
+
+    Returns:
+        list of verb frames per sentence in the same format as `srl_batch`
+    """
+    docs = get_nlp(DEPENDENCY_PIPES).pipe(sentences, batch_size=batch_size)
+    return [[_dependency_frame(doc, t) for t in doc if t.pos == S.VERB]
+            for doc in docs]
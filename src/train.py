@@ -1,12 +1,13 @@
 from dataclasses import dataclass, field
 from datetime import datetime
+import os
 import pickle
 from pprint import pprint
 from re import sub
 from typing import Callable, Iterable, List, Mapping, Tuple, Union
 
 from accelerate import Accelerator
-from datasets import load_dataset, load_metric
+from datasets import Dataset, load_dataset, load_from_disk, load_metric
 from datasets.dataset_dict import DatasetDict
 from more_itertools import pairwise
 import numpy as np
@@ -20,6 +21,7 @@ from torchmetrics.text.bert import BERTScore
 from transformers import Adafactor, AdamW, get_linear_schedule_with_warmup, get_cosine_schedule_with_warmup
 import wandb
 
+from src_old.constants import DATA_ROOT
 from src_old.models.neural_empathy import NeuralEmpathy, ModelConfig
 from src_old.utils import init_from_checkpoint
 
@@ -290,6 +292,23 @@ class Manager:
 
         return turns
 
+    def _precomputed(self, sample: Mapping[str, str]) -> Mapping[str, object]:
+        """Collects knowledge and turn type precomputed by `precompute_knowledge`
+
+        Args:
+            sample - an entry from dataset
+
+        Returns:
+            keyword arguments for the model, empty if retrieval has to run live
+        """
+        kwargs = {}
+        if all(k in sample for k in ('event', 'mental', 'moral')):
+            kwargs['knowledge'] = (sample['event'], sample['mental'],
+                                   sample['moral'])
+        if 'turn_type' in sample:
+            kwargs['turn_type'] = sample['turn_type']
+        return kwargs
+
     def training_step(self, sample: Iterable[str]) -> Tuple[Tensor]:
         """Training step
 
@@ -305,7 +324,7 @@ class Manager:
         nxt = sample['next']
         self.model.zero_grad()
         self.optimizer.zero_grad()
-        out = self.model(history, current, nxt)
+        out = self.model(history, current, nxt, **self._precomputed(sample))
         loss = out.loss
         logits = out.logits
         loss.backward()
@@ -329,7 +348,7 @@ class Manager:
             history = sample['history']
             current = sample['current']
             nxt = sample['next']
-            out = self.model(history, current, nxt)
+            out = self.model(history, current, nxt, **self._precomputed(sample))
             loss = out.loss
             logits = out.logits
             return logits, loss
@@ -338,24 +357,29 @@ class Manager:
                        dialog_history: str,
                        current_utterance: str,
                        response: str = None,
+                       precomputed: Mapping[str, object] = None,
                        **generation_settings) -> Union[str, List[str]]:
         """Inference
 
         Args:
             dialog_history - the dialog history as a concatenated string
             current_utterance - the current utterance
+            precomputed - knowledge and turn type from `_precomputed`
             **generation_settings - settings for generation
 
         Returns:
             generated response
         """
+        precomputed = precomputed or {}
         self.model.eval()
         with torch.no_grad():
             if generation_settings is not None:
                 out = self.model.inference(dialog_history, current_utterance,
+                                           **precomputed,
                                            **generation_settings)
             else:
-                out = self.model.inference(dialog_history, current_utterance)
+                out = self.model.inference(dialog_history, current_utterance,
+                                           **precomputed)
 
         if self.do_eval:
 
@@ -459,12 +483,35 @@ class Manager:
                 self._save_checkpoint(self.cfg.save_to)
 
 
+def load_training_data(
+        dataset: str = 'benjaminbeilharz/ed-for-lm',
+        precomputed: str = f'{DATA_ROOT}/ed-for-lm-knowledge',
+        split: str = None) -> Union[DatasetDict, Dataset]:
+    """Loads the dataset with knowledge columns from `precompute_knowledge`,
+    falls back to the raw dataset with live retrieval if it was not precomputed
+
+    Args:
+        dataset - huggingface dataset
+        precomputed - path of the precomputed dataset
+        split - split to load, defaults to all splits
+
+    Returns:
+        dataset or split
+    """
+    if os.path.exists(precomputed):
+        print(f'Loading precomputed knowledge from {precomputed}')
+        data = load_from_disk(precomputed)
+        return data if split is None else data[split]
+    print('No precomputed knowledge found, retrieving during training')
+    return load_dataset(dataset, split=split)
+
+
 def main():
     cfg = TrainingConfig()
     mcfg = ModelConfig()
     gcfg = GenerationConfig().__dict__
     #print('Config: ', gcfg)
-    dataset = load_dataset('benjaminbeilharz/ed-for-lm')
+    dataset = load_training_data()
     #mcfg.lm_checkpoint = 'benjaminbeilharz/t5-conditioned-next-turn'
 
     # trainer = Manager(cfg, mcfg, NeuralEmpathy, Adafactor, dataset)
@@ -484,7 +531,7 @@ def main():
     # trainer = Manager.load_from_config(train_cfg, model_cfg, checkpoint, NeuralEmpathy, Adafactor, dataset)
 
     # EVAL:
-    test_data = load_dataset('benjaminbeilharz/ed-for-lm', split='test')
+    test_data = load_training_data(split='test')
     trainer = Manager.load_from_config(train_cfg, model_cfg, checkpoint,
                                        NeuralEmpathy, AdamW, dataset)
     for sample in test_data:
@@ -494,6 +541,7 @@ def main():
         trainer.inference_step(dialog_history=history,
                                current_utterance=current,
                                response=response,
+                               precomputed=trainer._precomputed(sample),
                                **gcfg)
 
 